@@ -0,0 +1,47 @@
+"""Measure per-message Ratelimiter cost as the number of active users grows.
+
+Traffic runs on a simulated clock at RATE messages a second, so cooldowns
+lapse and users are evicted the way they would be in production. Run from
+the repository root with `python -m benchmarks.ratelimiter`.
+"""
+
+from random import Random
+from time import perf_counter
+
+from src.utils.ratelimiter import Ratelimiter
+
+CHANNELS = ["general", "memes", "staff", "gaming"]
+MESSAGES = 200_000
+RATE = 1_000
+
+
+def run(users: int) -> tuple:
+    limiter = Ratelimiter()
+    rng = Random(users)
+    ids = [rng.getrandbits(63) for _ in range(users)]
+
+    traffic = [
+        (ids[rng.randrange(users)], CHANNELS[rng.randrange(len(CHANNELS))])
+        for _ in range(MESSAGES)
+    ]
+
+    begin = perf_counter()
+    rejected = 0
+    for i, (user_id, channel) in enumerate(traffic):
+        rejected += limiter.message(user_id, channel, i / RATE) != 0
+    elapsed = perf_counter() - begin
+
+    tracked = sum(len(state.users) for state in limiter.channels.values())
+
+    return elapsed / MESSAGES * 1e9, rejected, tracked
+
+
+def main():
+    print(f"{'users':>10} {'ns/message':>12} {'rejected':>10} {'tracked':>10}")
+    for users in (1_000, 10_000, 100_000, 1_000_000):
+        ns, rejected, tracked = run(users)
+        print(f"{users:>10} {ns:>12.0f} {rejected:>10} {tracked:>10}")
+
+
+if __name__ == "__main__":
+    main()
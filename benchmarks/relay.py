@@ -0,0 +1,470 @@
+"""Drive Core.on_message with fake Discord objects and report relay throughput.
+
+Run from the repository root, for example:
+
+    python -m benchmarks.relay --guilds 200 --links 150 --messages 2000 --rate 50
+    python -m benchmarks.relay --store postgres --latency 80 --ratelimit 0.01
+
+The memory and sqlite stores need no services, sqlite uses a temporary file.
+The postgres store uses the normal DB_* environment variables and writes into
+that database, so point it at a scratch database.
+"""
+
+from argparse import ArgumentParser
+from asyncio import Event, gather, get_event_loop, run, sleep
+from collections import Counter, defaultdict, namedtuple
+from datetime import datetime
+from functools import partial
+from discord.utils import time_snowflake
+from itertools import count
+from loguru import logger
+from random import Random
+from sys import stderr
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from src.cogs.core import Core
+from src.utils.database import Database, Guild, Message, PostgresDatabase, User
+from src.utils.filter import init_words
+from src.utils.scheduler import Dropped, Priority, Scheduler
+from src.utils.sqlite import SQLiteDatabase
+
+Payload = namedtuple("Payload", ["message_id", "channel_id", "guild_id"])
+
+# Messages are varied chatter, so the spam detector doesn't reject them as a raid
+CHATTER = (
+    "hello there general kenobi how is everyone doing today did you see the "
+    "game last night anyone want to play later what are you working on"
+).split()
+
+ids = count()
+
+
+def snowflake() -> int:
+    # Real timestamps so relay latency maths works, plus a counter for uniqueness
+    return time_snowflake(datetime.utcnow()) + next(ids) % (1 << 22)
+
+
+class FakeHTTP:
+    """Stands in for Discord's API with fixed latency and random 429s."""
+
+    def __init__(self, rng: Random, latency: float, ratelimit: float):
+        self.rng = rng
+        self.latency = latency
+        self.ratelimit = ratelimit
+        self.requests = Counter()
+
+    async def request(self, route: str):
+        while True:
+            self.requests[route] += 1
+            await sleep(self.latency)
+
+            if self.rng.random() >= self.ratelimit:
+                return
+
+            # Retry after the bucket resets, as discord.py would
+            self.requests["429"] += 1
+            await sleep(self.latency * 5)
+
+    async def edit_message(self, channel_id: int, message_id: int, **fields):
+        await self.request("edit")
+
+    async def delete_message(self, channel_id: int, message_id: int):
+        await self.request("delete")
+
+    async def delete_messages(self, channel_id: int, message_ids: list):
+        await self.request("bulk_delete")
+
+
+class FakeColour:
+    value = 0x87CEEB
+
+
+class FakeRole:
+    colour = FakeColour()
+
+
+class FakeGuild:
+    def __init__(self, id: int):
+        self.id = id
+        self.name = f"Guild {id}"
+
+
+class FakeMember:
+    bot = False
+
+    def __init__(self, id: int, guild: FakeGuild = None):
+        self.id = id
+        self.guild = guild
+        self.roles = [FakeRole()]
+        self.colour = FakeColour()
+        self.avatar_url = f"https://cdn.discordapp.com/avatars/{id}/a.png"
+
+    def __str__(self):
+        return f"user{self.id}#0001"
+
+    async def send(self, content: str):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, channel, author, content: str = "", embed=None):
+        self.id = snowflake()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.embed = embed
+        self.created_at = datetime.utcnow()
+        self.reference = None
+        self.attachments = []
+
+    async def delete(self, delay: float = None):
+        pass
+
+    async def reply(self, content: str, **kwargs):
+        pass
+
+
+class FakeChannel:
+    def __init__(self, id: int, guild: FakeGuild, http: FakeHTTP, user: FakeMember):
+        self.id = id
+        self.guild = guild
+        self.http = http
+        self.user = user
+        self.mention = f"<#{id}>"
+
+    async def send(self, content: str = "", embed=None, **kwargs):
+        await self.http.request("send")
+        return FakeMessage(self, self.user, content, embed)
+
+
+class MemoryDatabase(Database):
+    """Keeps everything in dicts, counting the queries it stands in for."""
+
+    def __init__(self):
+        super().__init__()
+        self.configs = {}
+        self.rows = {}
+        self.broadcasts = defaultdict(list)
+        self.queries = Counter()
+
+    async def _load_guild(self, guild_id: int):
+        self.queries["get_guild"] += 1
+        config = self.configs.get(guild_id)
+        return Guild(guild_id, config, datetime.utcnow()) if config else None
+
+    async def _load_user(self, user_id: int):
+        self.queries["get_user"] += 1
+        return User(user_id, 0, False, datetime.utcnow())
+
+    async def get_all_guilds(self):
+        self.queries["get_all_guilds"] += 1
+        return [Guild(id, c, datetime.utcnow()) for id, c in self.configs.items()]
+
+    async def create_message(self, message, bcid: int, attachments=None):
+        self.queries["create_message"] += 1
+        content = message.content if message.id == bcid else None
+        row = Message(
+            message.id,
+            bcid,
+            message.guild.id,
+            message.channel.id,
+            message.author.id,
+            content,
+            False,
+            attachments if message.id == bcid and attachments else (),
+        )
+        self.rows[message.id] = row
+        self.broadcasts[bcid].append(row)
+
+    async def get_message(self, id: int, archived: bool = False):
+        self.queries["get_message"] += 1
+        return self.rows.get(id)
+
+    async def get_messages(self, bcid: int, archived: bool = False):
+        self.queries["get_messages"] += 1
+        return self.broadcasts.get(bcid, [])
+
+    async def get_broadcasts(self, ids: list):
+        self.queries["get_broadcasts"] += 1
+        bcids = {self.rows[id].bcid for id in ids if id in self.rows}
+        return {bcid: self.broadcasts[bcid] for bcid in bcids}
+
+    async def mark_deleted(self, ids: list):
+        self.queries["mark_deleted"] += 1
+        for id in ids:
+            row = self.rows.get(id)
+            if row is not None:
+                self.rows[id] = row._replace(deleted=True)
+                copies = self.broadcasts[row.bcid]
+                copies[copies.index(row)] = self.rows[id]
+
+
+class Counting:
+    """Counts the round trips a real backend makes."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queries = Counter()
+
+    async def execute(self, query: str, *args):
+        self.queries["execute"] += 1
+        return await super().execute(query, *args)
+
+    async def fetchrow(self, query: str, *args):
+        self.queries["fetchrow"] += 1
+        return await super().fetchrow(query, *args)
+
+    async def fetch(self, query: str, *args):
+        self.queries["fetch"] += 1
+        return await super().fetch(query, *args)
+
+    async def write_messages(self, rows: list):
+        self.queries["write_messages"] += 1
+        return await super().write_messages(rows)
+
+
+class CountingPostgres(Counting, PostgresDatabase):
+    pass
+
+
+class CountingSQLite(Counting, SQLiteDatabase):
+    pass
+
+
+class FakeBot:
+    """Just enough of Bot for the Core cog."""
+
+    def __init__(self, db: Database, http: FakeHTTP, budget: float, workers: int):
+        self.loop = get_event_loop()
+        self.db = db
+        self.http = http
+        self.scheduler = Scheduler(rate=budget, burst=budget, workers=workers)
+        self.started = Event()
+        self.emojis = []
+
+        self.user = FakeMember(next(ids))
+        self.user.bot = True
+
+        self.guilds = {}
+        self.channels = {}
+        self.members = {}
+
+    def add_startup_stage(self, name: str, stage):
+        pass
+
+    async def wait_until_started(self, *_):
+        await self.started.wait()
+
+    def get_channel(self, id: int):
+        return self.channels.get(id)
+
+    def get_guild(self, id: int):
+        return self.guilds.get(id)
+
+    def get_user(self, id: int):
+        return next(iter(self.members.get(id, {}).values()), None)
+
+
+def build(bot: FakeBot, args) -> dict:
+    """Create guilds and link channels to global channels round robin."""
+    configs = {}
+
+    for g in range(args.guilds):
+        guild = FakeGuild(10_000 + g)
+        bot.guilds[guild.id] = guild
+        configs[guild.id] = {"channels": {}}
+
+    guilds = list(bot.guilds.values())
+    for glob in range(args.globals):
+        for link in range(args.links):
+            guild = guilds[(glob * args.links + link) % len(guilds)]
+            channel = FakeChannel(next(ids) + 1_000_000, guild, bot.http, bot.user)
+
+            bot.channels[channel.id] = channel
+            configs[guild.id]["channels"][str(channel.id)] = f"global{glob}"
+
+    # Members are per guild, as they are on Discord
+    for u in range(args.users):
+        bot.members[u + 1] = {}
+
+    return configs
+
+
+async def bench(args):
+    rng = Random(args.seed)
+    http = FakeHTTP(rng, args.latency / 1000, args.ratelimit)
+
+    if args.store == "postgres":
+        db = CountingPostgres()
+        await db.setup()
+        await db.retention.maintain()
+    elif args.store == "sqlite":
+        directory = TemporaryDirectory()
+        db = CountingSQLite(f"{directory.name}/bench.db")
+        await db.setup()
+    else:
+        db = MemoryDatabase()
+
+    bot = FakeBot(db, http, args.budget, args.workers)
+    configs = build(bot, args)
+
+    if isinstance(db, MemoryDatabase):
+        db.configs = configs
+    else:
+        for guild_id, config in configs.items():
+            await db.update_guild(guild_id, config)
+
+    core = Core(bot)
+    await core.setup()
+    bot.started.set()
+
+    # Time each broadcast from the message being posted to its last copy
+    # being settled, by following the scheduler futures of its deliveries.
+    # Copies dropped from a full queue never run, so they are counted here
+    posted = {}
+    remaining = {}
+    latencies = []
+    delivered = []
+    dropped = Counter()
+    broadcasting = []
+    done = Event()
+    broadcast, submit = core.broadcast, bot.scheduler.submit
+
+    async def timed_broadcast(msgid: int, channel: str, **kwargs):
+        remaining[msgid] = len(core.routes.destinations(channel))
+
+        # Every delivery is submitted before broadcast first yields
+        broadcasting.append(msgid)
+        try:
+            await broadcast(msgid, channel, **kwargs)
+        finally:
+            broadcasting.pop()
+
+    def settle(bcid: int, future):
+        if not future.cancelled() and isinstance(future.exception(), Dropped):
+            dropped[bcid] += 1
+
+        remaining[bcid] -= 1
+        if not remaining[bcid]:
+            del remaining[bcid]
+            latencies.append(perf_counter() - posted.pop(bcid))
+            if not dropped[bcid]:
+                delivered.append(bcid)
+            if not remaining and finished:
+                done.set()
+
+    def tracked_submit(priority, coro, *args, **kwargs):
+        future = submit(priority, coro, *args, **kwargs)
+        if priority is Priority.RELAY and broadcasting:
+            future.add_done_callback(partial(settle, broadcasting[-1]))
+        return future
+
+    core.broadcast, bot.scheduler.submit = timed_broadcast, tracked_submit
+
+    channels = list(bot.channels.values())
+    words = sorted(init_words)
+    finished = False
+    deletes = []
+
+    begin = perf_counter()
+    for _ in range(args.messages):
+        channel = channels[rng.randrange(len(channels))]
+        user_id = rng.randrange(1, args.users + 1)
+        author = bot.members[user_id].get(channel.guild.id)
+        if author is None:
+            author = FakeMember(user_id, channel.guild)
+            bot.members[user_id][channel.guild.id] = author
+
+        text = " ".join(rng.choices(CHATTER, k=rng.randint(3, 12)))
+        if rng.random() < args.hit_ratio:
+            text += " " + words[rng.randrange(len(words))]
+
+        message = FakeMessage(channel, author, text)
+        posted[message.id] = perf_counter()
+        await core.on_message(message)
+
+        if message.id not in remaining:
+            # Rejected by the limiter or as spam, nothing will be delivered
+            posted.pop(message.id, None)
+
+        if delivered and rng.random() < args.delete_ratio:
+            # Someone deletes a copy of the latest fully delivered broadcast
+            group = core.relations.get(delivered[-1])
+            for id, channel_id in group.siblings() if group else ():
+                payload = Payload(id, channel_id, 0)
+                deletes.append(
+                    bot.loop.create_task(core.on_raw_message_delete(payload))
+                )
+                break
+
+        if args.rate:
+            await sleep(1 / args.rate)
+
+    finished = True
+    if remaining:
+        await done.wait()
+    await gather(*deletes)
+    elapsed = perf_counter() - begin
+
+    latencies.sort()
+
+    def percentile(p: float) -> float:
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+
+    rejected = args.messages - len(latencies)
+    incomplete = sum(1 for count in dropped.values() if count)
+
+    await bot.scheduler.close()
+    if isinstance(db, Counting):
+        await db.close()
+
+    print(f"messages:        {args.messages}")
+    print(f"relayed:         {len(latencies)} ({rejected} rejected)")
+    print(
+        f"dropped copies:  {sum(dropped.values())} "
+        f"({incomplete} broadcasts incomplete)"
+    )
+    print(f"messages/sec:    {args.messages / elapsed:.1f}")
+    print(f"fan-out p50:     {percentile(0.50):.1f}ms")
+    print(f"fan-out p99:     {percentile(0.99):.1f}ms")
+    print(f"http requests:   {dict(http.requests)}")
+    print(f"db queries:      {dict(db.queries)}")
+    print(
+        f"relation cache:  {core.relations.hits} hits, {core.relations.misses} misses"
+    )
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--store", choices=["memory", "sqlite", "postgres"], default="memory"
+    )
+    parser.add_argument("--guilds", type=int, default=100)
+    parser.add_argument("--globals", type=int, default=1, help="global channels")
+    parser.add_argument("--links", type=int, default=100, help="channels per global")
+    parser.add_argument("--users", type=int, default=5_000)
+    parser.add_argument("--messages", type=int, default=1_000)
+    parser.add_argument(
+        "--rate", type=float, default=0, help="messages/sec, 0 = flat out"
+    )
+    parser.add_argument("--hit-ratio", type=float, default=0.1)
+    parser.add_argument("--delete-ratio", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=50, help="ms per request")
+    parser.add_argument("--ratelimit", type=float, default=0.0, help="429 probability")
+    parser.add_argument("--budget", type=float, default=1e9, help="requests/sec")
+    parser.add_argument("--workers", type=int, default=16, help="scheduler workers")
+    parser.add_argument("--seed", type=int, default=0)
+
+    # Per-message info logs would dominate the measurement
+    logger.remove()
+    logger.add(stderr, level="WARNING")
+
+    run(bench(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,47 @@
+"""Measure per-message SpamDetector cost as traffic within the window grows.
+
+Run from the repository root with `python -m benchmarks.spam`.
+"""
+
+from random import Random
+from time import perf_counter
+
+from src.utils.spam import SpamDetector
+
+WORDS = (
+    "the a to and of is in it you that he was for on are with as his they at be "
+    "this have from or one had by word but not what all were we when your can "
+    "said there use an each which she do how their if will up other about out"
+).split()
+MESSAGES = 50_000
+
+
+def run(rate: int) -> tuple:
+    """Feed `rate` messages a second of mostly unique chatter with a raid mixed in."""
+    detector = SpamDetector()
+    rng = Random(rate)
+
+    raid = "join my server for free nitro right now everyone is already there"
+    traffic = [
+        raid if rng.random() < 0.01 else " ".join(rng.choices(WORDS, k=12))
+        for _ in range(MESSAGES)
+    ]
+
+    begin = perf_counter()
+    rejected = 0
+    for i, content in enumerate(traffic):
+        rejected += detector.message(content, i, i % 50, now=i / rate)
+    elapsed = perf_counter() - begin
+
+    return elapsed / MESSAGES * 1e9, rejected, len(detector.recent)
+
+
+def main():
+    print(f"{'msgs/sec':>10} {'ns/message':>12} {'rejected':>10} {'indexed':>10}")
+    for rate in (10, 100, 1_000):
+        ns, rejected, indexed = run(rate)
+        print(f"{rate:>10} {ns:>12.0f} {rejected:>10} {indexed:>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,15 @@ from os import getenv
 
 from src.internal.bot import Bot
 
-bot = Bot()
+# Rescan workers are spawned and import this module, only the parent runs the bot
+if __name__ == "__main__":
+    bot = Bot()
 
-bot.load_extensions(
-    "jishaku",
-    "src.cogs.core",
-    "src.cogs.config",
-    "src.cogs.errors",
-)
+    bot.load_extensions(
+        "jishaku",
+        "src.cogs.core",
+        "src.cogs.config",
+        "src.cogs.errors",
+    )
 
-bot.run(getenv("TOKEN"))
+    bot.run(getenv("TOKEN"))
@@ -36,7 +36,7 @@ class Config(commands.Cog):
             config["channels"][str(ctx.channel.id)] = channel
 
         await self.bot.db.update_guild(ctx.guild.id, config)
-        await self.bot.cogs["Core"].setup()
+        await self.bot.cogs["Core"].update_guild(ctx.guild.id)
         await ctx.reply(f"Successfully linked {ctx.channel.mention} to cc:#{channel}")
 
     @commands.command(name="unlink")
@@ -63,9 +63,26 @@ class Config(commands.Cog):
             )
 
         await self.bot.db.update_guild(ctx.guild.id, config)
-        await self.bot.cogs["Core"].setup()
+        await self.bot.cogs["Core"].update_guild(ctx.guild.id)
         await ctx.reply(f"Successfully unlinked {channel.mention} from cc:#{old}")
 
+    @commands.command(name="transport")
+    @commands.check_any(level(100), commands.has_guild_permissions(manage_guild=True))
+    async def transport(self, ctx: commands.Context, transport: str):
+        """Choose whether messages are delivered as bot embeds or through webhooks."""
+
+        if transport not in ("embed", "webhook"):
+            return await ctx.reply("Transport must be one of `embed` or `webhook`.")
+
+        guild = await self.bot.db.get_guild(ctx.guild.id)
+
+        config = guild.config
+        config["transport"] = transport
+
+        await self.bot.db.update_guild(ctx.guild.id, config)
+        await self.bot.cogs["Core"].update_guild(ctx.guild.id)
+        await ctx.reply(f"Messages will now be delivered using {transport}s.")
+
     @commands.command(name="spl")
     @level(100)
     async def set_perm_level(
@@ -1,15 +1,64 @@
 from discord.ext import commands
-from discord.utils import escape_mentions
-from discord import Message, TextChannel, Embed, RawMessageDeleteEvent
+from discord.utils import escape_mentions, snowflake_time, time_snowflake
+from discord import Message, TextChannel, Embed, File, Guild, Member, Role, User
+from discord import Attachment, HTTPException, MessageReference
+from discord import RawBulkMessageDeleteEvent, RawMessageDeleteEvent
+from discord import RawMessageUpdateEvent
 from collections import defaultdict
+from functools import partial
 from loguru import logger
+from typing import Dict, List, Optional, Tuple
+from asyncio import Future, gather, wait
+from datetime import datetime, timedelta
+from pathlib import Path
 
 from src.internal.bot import Bot
-from src.utils.filter import MessageFilter
+from src.utils.filter import MessageFilter, results
 from src.utils.ratelimiter import Ratelimiter
+from src.utils.spam import SpamDetector
 from src.utils.emojifix import EmojiFixer
+from src.utils.relations import Relations, Broadcast
+from src.utils.webhooks import WebhookTransport
+from src.utils.scheduler import Dropped, Priority
+from src.utils.metrics import registry
+from src.utils.cache import LRU
+from src.utils.routing import RoutingTable
+from src.utils.headers import HeaderCache
+from src.utils.attachments import IMAGES, AttachmentStore
+from src.utils.rescan import REPORTS, Hit, Rescan
 from src.utils.checks import level
 
+STAGES = registry.histogram(
+    "crosschat_relay_stage_seconds", "Time spent in each stage of on_message."
+)
+SENDS = registry.histogram(
+    "crosschat_send_seconds", "Time taken to deliver one copy to a destination."
+)
+RELAYS = registry.histogram(
+    "crosschat_relay_seconds",
+    "Time from a message being posted to its last copy being delivered.",
+)
+FILTER_HITS = registry.counter(
+    "crosschat_filter_hits_total", "Copies that had words censored by a filter."
+)
+REJECTIONS = registry.counter(
+    "crosschat_limiter_rejections_total", "Messages rejected by the ratelimiter."
+)
+
+SPAM = registry.counter(
+    "crosschat_spam_rejections_total",
+    "Messages rejected as copies of text many others just posted.",
+)
+
+# Seconds to wait for more edits to an original before updating its copies
+EDIT_DELAY = 2.0
+
+# Discord only bulk deletes messages younger than two weeks, leave some slack
+BULK_DELETE_AGE = timedelta(days=14, minutes=-5)
+
+# Longer embed descriptions are rejected, failing the send or edit outright
+DESCRIPTION_LIMIT = 4096
+
 
 class Core(commands.Cog):
     """Core functionality for CrossChat."""
@@ -18,10 +67,52 @@ class Core(commands.Cog):
         self.bot = bot
 
         self.filters = {}
+        self.routes = RoutingTable(bot)
+        self.webhook_guilds = set()
         self.limiter = Ratelimiter()
+        self.spam = SpamDetector()
         self.emojifier = EmojiFixer(bot)
+        self.relations = Relations()
+        self.webhooks = WebhookTransport(bot)
+        self.headers = HeaderCache(10_000)
+        self.attachments = AttachmentStore(bot)
+        self.rescans = {}
+
+        # The latest content of originals edited in the last EDIT_DELAY seconds
+        self.revisions = {}
+
+        # Copies we deleted ourselves, so their delete events are ignored
+        self.deleted = LRU(10_000)
 
-        self.bot.loop.run_until_complete(self.setup())
+        # Local copy of each broadcast by (bcid, channel ID), for threading replies
+        self.copies = LRU(50_000)
+
+        # Copies still to be delivered per broadcast, for end-to-end latency
+        self.inflight = LRU(10_000)
+
+        registry.gauge(
+            "crosschat_cache_hits_total",
+            "Cache lookups that were hits.",
+            lambda: [
+                ({"cache": "relations"}, self.relations.hits),
+                ({"cache": "filter"}, results.hits),
+                ({"cache": "headers"}, self.headers.hits),
+            ],
+            kind="counter",
+        )
+        registry.gauge(
+            "crosschat_cache_misses_total",
+            "Cache lookups that were misses.",
+            lambda: [
+                ({"cache": "relations"}, self.relations.misses),
+                ({"cache": "filter"}, results.misses),
+                ({"cache": "headers"}, self.headers.misses),
+            ],
+            kind="counter",
+        )
+
+        self.bot.add_startup_stage("routing", self.setup)
+        self.bot.db.subscribe(self.on_invalidate)
 
     @staticmethod
     def get_badge(level: int):
@@ -38,36 +129,77 @@ class Core(commands.Cog):
     def censor_embed(embed: Embed, filter: MessageFilter) -> Embed:
         if embed.description:
             result = filter(embed.description)
-            embed.description = result.message
+            if result.changed:
+                embed = embed.copy()
+                embed.description = result.message
         return embed
 
     def create_embed(self, message: Message, badge: str) -> Embed:
-        tcr = 0
-        for role in message.author.roles:
-            if role.colour.value:
-                tcr = role.colour.value
-
         message.content = self.emojifier.message(escape_mentions(message.content))
 
-        embed = Embed(
-            description=message.content,
-            colour=tcr,
-            timestamp=message.created_at,
+        return self.render_embed(
+            message.author, message.content, message.created_at, badge
         )
 
-        embed.set_author(
-            name=f"{message.author} {badge}",
-            icon_url=str(message.author.avatar_url),
-        )
+    def render_embed(
+        self, member: Member, content: str, timestamp: datetime, badge: str
+    ) -> Embed:
+        header = self.headers.render(member, badge)
+
+        embed = Embed(description=content, colour=header.colour, timestamp=timestamp)
 
-        embed.set_footer(text=str(message.author.id) + " • " + message.guild.name)
+        embed.set_author(name=header.name, icon_url=header.icon_url)
+        embed.set_footer(text=header.footer)
 
         return embed
 
+    async def relay_attachments(
+        self, attachments: List[Attachment]
+    ) -> List[Tuple[str, str]]:
+        """Get (filename, url) for each attachment, using relayed copies."""
+        urls = await gather(*[self.attachments.url(a) for a in attachments])
+
+        return [(a.filename, url) for a, url in zip(attachments, urls) if url]
+
+    @staticmethod
+    def attach(embed: Embed, files: List[Tuple[str, str]]):
+        """Show relayed attachments in an embed, the first image inline."""
+        image = None
+        links = []
+
+        for filename, url in files:
+            if image is None and Path(filename).suffix.lower() in IMAGES:
+                image = url
+            else:
+                links.append(f"[{filename}]({url})")
+
+        if image:
+            embed.set_image(url=image)
+        if not links:
+            return
+
+        # Links get at most half the description, the text is cut to fit the rest
+        shown = []
+        for link in links:
+            if sum(len(l) + 1 for l in shown) + len(link) > DESCRIPTION_LIMIT // 2:
+                break
+            shown.append(link)
+        if len(shown) < len(links):
+            shown.append(f"and {len(links) - len(shown)} more attachments")
+
+        footer = "\n".join(shown)
+        room = DESCRIPTION_LIMIT - len(footer) - 1
+
+        text = embed.description or ""
+        if len(text) > room:
+            text = text[: room - 1] + "…"
+
+        embed.description = "\n".join(filter(None, [text, footer]))
+
     def should_ignore(self, message: Message):
         if message.author.bot or not message.guild:
             return True
-        if message.channel.id not in self.channel_mapping:
+        if message.channel.id not in self.routes:
             return True
         for pref in ["!", "c!", "]"]:
             if message.content.lower().startswith(pref):
@@ -77,58 +209,106 @@ class Core(commands.Cog):
     def init_filter(self, guild_id: int, words: list):
         self.filters[guild_id] = MessageFilter(words)
 
+    def apply_guild(self, guild_id: int, config: dict):
+        """Apply a single guild's config to the routing table, filter and transport."""
+        self.routes.apply(guild_id, config)
+
+        words = config.get("words", [])
+        ft = self.filters.get(guild_id)
+        if not ft or ft.words != MessageFilter.expand(words):
+            self.init_filter(guild_id, words)
+
+        if config.get("transport") == "webhook":
+            self.webhook_guilds.add(guild_id)
+        else:
+            self.webhook_guilds.discard(guild_id)
+
+    async def update_guild(self, guild_id: int):
+        """Reload one guild's config after it changes."""
+        await self.bot.wait_until_started()
+
+        guild = await self.bot.db.get_guild(guild_id)
+        self.apply_guild(guild_id, guild.config)
+
     async def setup(self):
         """Set up the bot ready for execution."""
         logger.info("Setting up core...")
 
-        self.channel_mapping = {}
-        self.channels = defaultdict(set)
-
         guilds = await self.bot.db.get_all_guilds()
         for guild in guilds:
-            channels = guild.config.get("channels", {})
+            self.apply_guild(guild.id, guild.config)
+
+        logger.info("Core setup complete.")
 
-            for local, glob in channels.items():
-                local = int(local)
-                self.channel_mapping[local] = glob
-                self.channels[glob].add(local)
+    def on_invalidate(self, table: str, id: int):
+        """Refresh routes and headers after changes, possibly in another process."""
+        if table == "guilds":
+            self.bot.loop.create_task(self.update_guild(id))
+        elif table == "users":
+            self.headers.user(id)  # The badge depends on permissions
+        elif table == "*":
+            self.headers.clear()
+            self.bot.loop.create_task(self.setup())
 
-            self.init_filter(guild.id, guild.config.get("words", []))
+    async def _broadcasts(self, ids: List[int]) -> Dict[int, Broadcast]:
+        """Get the broadcasts of many messages by bcid, with at most one query."""
+        groups = {}
+        missing = []
 
-        logger.info("Core setup complete.")
+        for id in ids:
+            group = self.relations.get(id)
+            if group:
+                groups[group.bcid] = group
+            else:
+                missing.append(id)
+
+        if missing:
+            broadcasts = await self.bot.db.get_broadcasts(missing)
+            for bcid, messages in broadcasts.items():
+                groups[bcid] = self.relations.load(bcid, messages)
 
-    async def _siblings(self, id: int):
-        message = await self.bot.db.get_message(id)
+        return groups
 
-        return (await self.bot.db.get_messages(message.bcid)) or []
+    async def _broadcast(self, id: int, archived: bool = False) -> Optional[Broadcast]:
+        """Get the broadcast a message belongs to, only querying on a cache miss."""
+        group = self.relations.get(id)
+        if group:
+            return group
+
+        message = await self.bot.db.get_message(id, archived=archived)
+
+        if not message:
+            return None
+
+        messages = await self.bot.db.get_messages(message.bcid, archived=archived)
+        return self.relations.load(message.bcid, messages)
 
     async def _msginfo(self, id: int) -> Embed:
-        message = await self.bot.db.get_message(id)
+        group = await self._broadcast(id, archived=True)
 
-        if (not message) or message.id == message.bcid:
+        if (not group) or group.bcid == id or group.author_id is None:
             return Embed(description="No message found with that ID")
 
-        siblings = await self.bot.db.get_messages(message.bcid)
-        original = await self.bot.db.get_message(message.bcid)
-
         embed = Embed(
             title=f"Message Info - {id}",
             colour=0x87CEEB,
             description="",
         )
 
-        guild = self.bot.get_guild(original.guild_id)
-        channel = self.bot.get_channel(original.channel_id)
-        author = self.bot.get_user(original.author_id)
+        guild = self.bot.get_guild(group.guild_id)
+        channel = self.bot.get_channel(group.channel_id)
+        author = self.bot.get_user(group.author_id)
 
-        user = await self.bot.db.get_user(original.author_id)
+        user = await self.bot.db.get_user(group.author_id)
         _, rank = self.get_badge(user.permissions)
 
-        embed.description += f"Parent ID: {original.id}\n"
-        embed.description += f"Siblings: {', '.join([str(m.id) for m in siblings if m.id not in (original.id, id)])}\n"
-        embed.description += f"Guild: {original.guild_id} ({guild})\n"
-        embed.description += f"Channel: {original.channel_id} ({channel})\n"
-        embed.description += f"Author: {original.author_id} ({author}) ({rank})"
+        embed.description += f"Parent ID: {group.bcid}\n"
+        embed.description += (
+            f"Siblings: {', '.join([str(m) for m in group.ids if m != id])}\n"
+        )
+        embed.description += f"Guild: {group.guild_id} ({guild})\n"
+        embed.description += f"Channel: {group.channel_id} ({channel})\n"
+        embed.description += f"Author: {group.author_id} ({author}) ({rank})"
 
         return embed
 
@@ -140,54 +320,446 @@ class Core(commands.Cog):
             return await message.author.send(reason)
         await message.reply(reason, delete_after=delete_after)
 
-    async def _send(
-        self, bcid: int, channel: TextChannel, bypass: bool = False, **kwargs
-    ):
-        if not bypass:
-            ft = self.filters.get(channel.guild.id)
-            if "embed" in kwargs and ft:
-                kwargs["embed"] = self.censor_embed(kwargs["embed"], ft)
+    def _settle(self, bcid: int):
+        """Count one copy of a broadcast as done, delivered or not."""
+        remaining = self.inflight.get(bcid)
+        if remaining == 1:
+            self.inflight.pop(bcid)
+            delay = datetime.utcnow() - snowflake_time(bcid)
+            RELAYS.observe(delay.total_seconds())
+        elif remaining:
+            self.inflight.set(bcid, remaining - 1)
+
+    def _on_dropped(self, bcid: int, channel: TextChannel, future: Future):
+        # Dropped jobs never run, so _send can't settle or report them itself
+        if future.cancelled() or not isinstance(future.exception(), Dropped):
+            return
+
+        self._settle(bcid)
+        logger.warning(
+            f"Dropped copy of {bcid} for {channel.id}, the relay queue is full"
+        )
+
+    async def _send(self, bcid: int, channel: TextChannel, **kwargs):
+        try:
+            # Labelled by transport, a label per guild would be thousands of series
+            transport = "webhook" if channel.guild.id in self.webhook_guilds else "bot"
+            with SENDS.time(transport=transport):
+                await self._deliver(bcid, channel, **kwargs)
+        finally:
+            self._settle(bcid)
+
+    async def _deliver(self, bcid: int, channel: TextChannel, **kwargs):
+        message = None
 
-        message = await channel.send(**kwargs)
+        # Webhooks can't reply, so their copies go out without the reference
+        reference = kwargs.pop("reference", None)
+
+        if channel.guild.id in self.webhook_guilds:
+            try:
+                data = await self.webhooks.send(channel, **kwargs)
+                message = Message(
+                    state=self.bot._connection, channel=channel, data=data
+                )
+            except Exception as e:
+                logger.warning(
+                    f"Webhook send to {channel.id} failed, falling back: {e}"
+                )
+
+        if message is None and reference is not None:
+            try:
+                message = await channel.send(
+                    reference=reference, mention_author=False, **kwargs
+                )
+            except HTTPException as e:
+                # Most likely the copy being replied to was deleted meanwhile
+                logger.warning(f"Reply in {channel.id} failed, sending plain: {e}")
+
+        if message is None:
+            message = await channel.send(**kwargs)
 
         await self.bot.db.create_message(message, bcid)
+        self.relations.sibling(bcid, message.id, channel.id)
+        self.copies.set((bcid, channel.id), message.id)
 
         logger.info(f"Successfully sent message to {channel.id} [BCID: {bcid}]")
 
     async def _edit(self, channel: int, message: int, **kwargs):
-        channel = self.bot.get_channel(channel)
-        message = await channel.fetch_message(message)
-
-        await message.edit(**kwargs)
-        logger.info(f"Successfully edited message {message.id} in {channel.id}")
-
-    async def massedit(self, bcid: int, exclude: int = 0, **kwargs):
-        siblings = await self._siblings(bcid)
-
-        for sibling in siblings:
-            if (
-                sibling.id != bcid
-                and sibling.id != exclude
-                and sibling.id != sibling.bcid
-            ):
-                self.bot.loop.create_task(
-                    self._edit(sibling.channel_id, sibling.id, **kwargs)
-                )
+        # Edit by ID straight through the HTTP client, there's no need to fetch first
+        if "embed" in kwargs:
+            embed = kwargs["embed"]
+            kwargs["embed"] = embed.to_dict() if embed else None
+
+        destination = self.bot.get_channel(channel)
+        if destination and destination.guild.id in self.webhook_guilds:
+            try:
+                await self.webhooks.edit(destination, message, **kwargs)
+            except Exception:
+                # It may have been sent by the bot as a fallback
+                await self.bot.http.edit_message(channel, message, **kwargs)
+        else:
+            await self.bot.http.edit_message(channel, message, **kwargs)
+
+        logger.info(f"Successfully edited message {message} in {channel}")
+
+    async def _edit_routes(self, routes: Dict[int, List[int]], **kwargs) -> List[tuple]:
+        """Edit messages grouped by channel, returning (message ID, error) for failures.
+
+        Edits share Discord's per-channel rate limit bucket, so each channel's
+        edits run in sequence and channels run concurrently.
+        """
+        failures = []
+
+        async def edit_route(channel: int, messages: List[int]):
+            for message in messages:
+                try:
+                    await self._edit(channel, message, **kwargs)
+                except Exception as e:
+                    failures.append((message, e))
+
+        jobs = [
+            self.bot.scheduler.submit(
+                Priority.EDIT, edit_route(c, m), key=("edit", c, *m), cost=len(m)
+            )
+            for c, m in routes.items()
+        ]
+
+        for channel, result in zip(routes, await gather(*jobs, return_exceptions=True)):
+            if isinstance(result, Exception):
+                failures.extend((message, result) for message in routes[channel])
+
+        return failures
+
+    @staticmethod
+    def _log_failures(bcid: int, failures: List[tuple]):
+        if failures:
+            logger.warning(
+                f"Failed to edit {len(failures)} copies of {bcid}: "
+                + ", ".join(f"{m} ({e.__class__.__name__})" for m, e in failures)
+            )
+
+    async def massedit(self, id: int, exclude: int = 0, **kwargs) -> List[tuple]:
+        """Edit every copy of a broadcast, returning (message ID, error) for failures."""
+        group = await self._broadcast(id)
+
+        if not group:
+            return []
+
+        routes = defaultdict(list)
+        for sibling, channel in group.siblings():
+            if sibling != id and sibling != exclude:
+                routes[channel].append(sibling)
+
+        failures = await self._edit_routes(routes, **kwargs)
+        self._log_failures(group.bcid, failures)
+
+        return failures
+
+    async def _delete_routes(self, routes: Dict[int, List[int]]) -> List[tuple]:
+        """Delete copies grouped by channel, returning (message ID, error) for failures.
+
+        Recent copies are bulk deleted 100 at a time where the bot can manage
+        messages. The rest are deleted one by one, and copies that can't be
+        deleted are edited to say so instead.
+        """
+        failures = []
+        cutoff = time_snowflake(datetime.utcnow() - BULK_DELETE_AGE)
+
+        async def delete_route(channel: int, messages: List[int]):
+            destination = self.bot.get_channel(channel)
+            perms = destination and destination.permissions_for(destination.guild.me)
+            bulk = bool(perms and perms.manage_messages)
+
+            recent = [m for m in messages if bulk and m > cutoff]
+            single = [m for m in messages if not (bulk and m > cutoff)]
+
+            for i in range(0, len(recent), 100):
+                chunk = recent[i : i + 100]
+                if len(chunk) < 2:
+                    single += chunk
+                    continue
+                try:
+                    await self.bot.http.delete_messages(channel, chunk)
+                except Exception:
+                    single += chunk
+
+            for message in single:
+                try:
+                    await self.bot.http.delete_message(channel, message)
+                except Exception:
+                    try:
+                        await self._edit(
+                            channel, message, content="Message deleted.", embed=None
+                        )
+                    except Exception as e:
+                        failures.append((message, e))
+
+        jobs = [
+            self.bot.scheduler.submit(
+                Priority.EDIT,
+                delete_route(c, m),
+                key=("delete", c, *m),
+                cost=len(m) // 100 + 1,
+            )
+            for c, m in routes.items()
+        ]
+
+        for channel, result in zip(routes, await gather(*jobs, return_exceptions=True)):
+            if isinstance(result, Exception):
+                failures.extend((message, result) for message in routes[channel])
+
+        return failures
+
+    async def revise(self, bcid: int):
+        """Send the latest pending revision of an original to its copies."""
+        content = self.revisions.pop(bcid)
+
+        group = await self._broadcast(bcid)
+        original = await self.bot.db.get_message(bcid)
+        if not group or not original:
+            return
+
+        # The copies were replaced by "Message deleted.", editing would undo that
+        if group.deleted:
+            logger.info(f"Not propagating edit to {bcid}, it was deleted")
+            return
+
+        previous = original.content or ""
+        content = self.emojifier.message(escape_mentions(content))
+        if content == previous:
+            return
+
+        guild = self.bot.get_guild(group.guild_id)
+        member = guild.get_member(group.author_id) if guild else None
+        if member is None:
+            logger.warning(f"Not propagating edit to {bcid}, its author has left")
+            return
+
+        user = await self.bot.db.get_user(member.id)
+        badge, _ = self.get_badge(user.permissions)
+        bypass = self.routes.get(group.channel_id) == "staff" or user.permissions >= 10
+
+        embed = self.render_embed(member, content, snowflake_time(bcid), badge)
+        self.attach(embed, original.attachments)
+        await self.bot.db.update_message_content(bcid, content)
+
+        # Copies are grouped by filter, skipping groups whose censored text is the
+        # same as before
+        embeds = {}
+        routes = defaultdict(lambda: defaultdict(list))
+        for sibling, channel in group.siblings():
+            destination = self.bot.get_channel(channel)
+            if destination is None:
+                continue
+
+            ft = None if bypass else self.filters.get(destination.guild.id)
+            fingerprint = ft.fingerprint if ft else None
+
+            if fingerprint not in embeds:
+                if not ft:
+                    embeds[fingerprint] = embed
+                elif ft(previous).message != ft(content).message:
+                    embeds[fingerprint] = self.censor_embed(embed, ft)
+                else:
+                    embeds[fingerprint] = None
+
+            if embeds[fingerprint] is not None:
+                routes[fingerprint][channel].append(sibling)
 
-    async def broadcast(self, msgid: int, channel: str, **kwargs):
-        channels = self.channels.get(channel, [])
+        results = await gather(
+            *[self._edit_routes(c, embed=embeds[f]) for f, c in routes.items()]
+        )
+        self._log_failures(bcid, [failure for f in results for failure in f])
+
+    async def _censored_embed(self, group: Broadcast, hit: Hit) -> Optional[Embed]:
+        """Rebuild a copy's embed with the censored text, from stored data."""
+        guild = self.bot.get_guild(group.guild_id)
+        member = guild.get_member(group.author_id) if guild else None
+
+        if member is not None:
+            user = await self.bot.db.get_user(member.id)
+            badge, _ = self.get_badge(user.permissions)
+            embed = self.render_embed(
+                member, hit.censored, snowflake_time(hit.id), badge
+            )
+        else:
+            # The author has left so their header can't be rendered, reuse the one
+            # on a copy, which is the same for every copy of the broadcast
+            sibling, channel = next(group.siblings())
+            data = await self.bot.http.get_message(channel, sibling)
+            if not data.get("embeds"):
+                return None
+
+            embed = Embed.from_dict(data["embeds"][0])
+            embed.description = hit.censored
+
+        self.attach(embed, hit.attachments)
+        return embed
+
+    async def censor(self, guild_id: int, hits: List[Hit]) -> List[tuple]:
+        """Re-censor a guild's copies of matched messages, returning failures."""
+        channels = self.routes.guilds.get(guild_id, set())
+        groups = await self._broadcasts([hit.id for hit in hits])
+
+        routes = defaultdict(list)
+        failures = []
+        for hit in hits:
+            group = groups.get(hit.id)
+            if not group or group.deleted:
+                continue
+
+            copies = [(s, c) for s, c in group.siblings() if c in channels]
+            if not copies:
+                continue
+
+            try:
+                embed = await self._censored_embed(group, hit)
+            except Exception as e:
+                failures.extend((sibling, e) for sibling, _ in copies)
+                continue
+
+            if embed is not None:
+                for sibling, channel in copies:
+                    routes[channel].append((sibling, embed))
 
-        for cid in channels:
-            self.bot.loop.create_task(
-                self._send(msgid, self.bot.get_channel(cid), **kwargs)
+        async def edit_route(channel: int, copies: List[tuple]):
+            for message, embed in copies:
+                try:
+                    await self._edit(channel, message, embed=embed)
+                except Exception as e:
+                    failures.append((message, e))
+
+        jobs = [
+            self.bot.scheduler.submit(
+                Priority.EDIT, edit_route(c, m), key=("censor", c), cost=len(m)
             )
+            for c, m in routes.items()
+        ]
+
+        for channel, result in zip(routes, await gather(*jobs, return_exceptions=True)):
+            if isinstance(result, Exception):
+                failures.extend((message, result) for message, _ in routes[channel])
+
+        return failures
+
+    async def _rescan(self, ctx: commands.Context, hours: int, edit: bool):
+        guild_id = ctx.guild.id
+        ft = self.filters[guild_id]
+
+        # Everything relayed into this guild came from a channel on a linked global
+        globs = {
+            self.routes.get(local) for local in self.routes.guilds.get(guild_id, ())
+        }
+        channels = [local for g in globs for local in self.routes.channels.get(g, {})]
+
+        stop = datetime.utcnow()
+        job = Rescan(
+            self.bot.db,
+            ft.fingerprint,
+            channels,
+            stop - timedelta(hours=hours),
+            stop,
+        )
+
+        await self.bot.db.messages.flush()
+        status = await ctx.reply("Rescanning stored messages...")
+
+        task = self.bot.loop.create_task(job.run())
+        while not task.done():
+            await wait([task], timeout=5)
+            await status.edit(
+                content=f"Rescanning stored messages... {job.progress:.0%} "
+                f"({job.scanned} scanned, {len(job.hits)} matched)"
+            )
+
+        hits = task.result()
+        path = REPORTS / f"rescan_{guild_id}_{stop:%Y%m%d%H%M%S}.jsonl"
+        job.report(path)
+
+        summary = (
+            f"Rescanned {job.scanned} messages, {len(hits)} would now be censored."
+        )
+        if edit and hits:
+            failures = await self.censor(guild_id, hits)
+            summary += f" Re-censored copies, {len(failures)} edits failed."
+
+        await ctx.reply(summary, file=File(path))
+
+    def _reply_targets(
+        self, group: Broadcast, destinations: List[TextChannel]
+    ) -> Dict[int, int]:
+        """Map each destination's channel ID to its copy of a broadcast."""
+        targets = {}
+
+        for destination in destinations:
+            id = self.copies.get((group.bcid, destination.id))
+            if id is not None:
+                targets[destination.id] = id
+
+        # Copies delivered before a restart or since evicted are still siblings
+        if len(targets) < len(destinations):
+            for id, channel_id in group.siblings():
+                targets.setdefault(channel_id, id)
+
+        return targets
+
+    async def broadcast(
+        self,
+        msgid: int,
+        channel: str,
+        bypass: bool = False,
+        priority: Priority = Priority.RELAY,
+        reply: Optional[Broadcast] = None,
+        **kwargs,
+    ):
+        # Destinations sharing a filter configuration get the same censored embed
+        groups = defaultdict(list)
+        destinations = self.routes.destinations(channel)
+        targets = self._reply_targets(reply, destinations) if reply else {}
+        for destination in destinations:
+            ft = None if bypass else self.filters.get(destination.guild.id)
+            groups[ft.fingerprint if ft else None].append((destination, ft))
+
+        self.inflight.set(msgid, len(destinations))
+
+        for fingerprint, destinations in groups.items():
+            kw = kwargs
+            if fingerprint is not None and "embed" in kwargs:
+                kw = {
+                    **kwargs,
+                    "embed": self.censor_embed(kwargs["embed"], destinations[0][1]),
+                }
+
+            if kw is not kwargs and kw["embed"] is not kwargs["embed"]:
+                FILTER_HITS.inc(len(destinations))
+
+            for destination, _ in destinations:
+                target = targets.get(destination.id)
+                if target is not None:
+                    reference = MessageReference(
+                        message_id=target,
+                        channel_id=destination.id,
+                        guild_id=destination.guild.id,
+                    )
+                    coro = self._send(msgid, destination, reference=reference, **kw)
+                else:
+                    coro = self._send(msgid, destination, **kw)
+
+                # Webhooks have their own rate limits, apart from the bot's budget
+                cost = 0 if destination.guild.id in self.webhook_guilds else 1
+
+                future = self.bot.scheduler.submit(priority, coro, cost=cost)
+                future.add_done_callback(partial(self._on_dropped, msgid, destination))
 
     @commands.Cog.listener()
     async def on_message(self, message: Message):
+        await self.bot.wait_until_started()
+
         if self.should_ignore(message):
             return
 
-        user = await self.bot.db.get_user(message.author.id)
+        with STAGES.time(stage="get_user"):
+            user = await self.bot.db.get_user(message.author.id)
 
         if user.banned:
             return await self._reject(
@@ -195,35 +767,124 @@ class Core(commands.Cog):
             )
 
         badge, _ = self.get_badge(user.permissions)
-        embed = self.create_embed(message, badge)
+        with STAGES.time(stage="create_embed"):
+            embed = self.create_embed(message, badge)
 
-        gc = self.channel_mapping[message.channel.id]
+        gc = self.routes.get(message.channel.id)
         bypass = True if gc == "staff" or user.permissions >= 10 else False
 
         if not bypass:
-            if msg := self.limiter.message(message.author.id, gc):
+            with STAGES.time(stage="limiter"):
+                msg = self.limiter.message(message.author.id, gc)
+
+            if msg:
+                REJECTIONS.inc(channel=gc)
                 return await self._reject(
                     message,
                     f"Please wait between sending messages, try again after {msg}s",
                 )
 
-        await self.bot.db.create_message(message, message.id)
-        await self.broadcast(message.id, gc, embed=embed, bypass=bypass)
+            with STAGES.time(stage="spam"):
+                spam = self.spam.message(
+                    message.content, message.author.id, message.guild.id
+                )
+
+            if spam:
+                SPAM.inc(channel=gc)
+                return await self._reject(
+                    message, "This message matches one being posted by many others."
+                )
+
+        reply = None
+        if message.reference and message.reference.message_id:
+            with STAGES.time(stage="reply"):
+                reply = await self._broadcast(message.reference.message_id)
+
+        files = []
+        if message.attachments:
+            with STAGES.time(stage="attachments"):
+                files = await self.relay_attachments(message.attachments)
+                self.attach(embed, files)
+
+        with STAGES.time(stage="create_message"):
+            await self.bot.db.create_message(message, message.id, files)
+        self.relations.original(
+            message.id, message.guild.id, message.channel.id, message.author.id
+        )
+
+        with STAGES.time(stage="broadcast"):
+            await self.broadcast(
+                message.id, gc, embed=embed, bypass=bypass, reply=reply
+            )
         await message.delete(
             delay=0.3
         )  # If you remove a message too fast discord sometimes thinks it's still there
 
+    @commands.Cog.listener()
+    async def on_ready(self):
+        self.emojifier.rebuild()
+
+    @commands.Cog.listener()
+    async def on_guild_emojis_update(self, guild: Guild, before, after):
+        self.emojifier.rebuild()
+
+    @commands.Cog.listener()
+    async def on_guild_join(self, guild: Guild):
+        self.emojifier.rebuild()
+        await self.update_guild(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild: Guild):
+        self.emojifier.rebuild()
+        self.routes.remove(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild: Guild):
+        # Channels dropped while the guild was unavailable can be resolved again
+        await self.update_guild(guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: TextChannel):
+        self.routes.discard(channel.id)
+
+    @commands.Cog.listener()
+    async def on_guild_update(self, before: Guild, after: Guild):
+        if before.name != after.name:
+            self.headers.guild(after.id)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: Member, after: Member):
+        self.headers.member(after.guild.id, after.id)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before: User, after: User):
+        self.headers.user(after.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_update(self, before: Role, after: Role):
+        # Colour is taken from the top coloured role, so its position matters too
+        if before.colour != after.colour or before.position != after.position:
+            self.headers.guild(after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_role_delete(self, role: Role):
+        self.headers.guild(role.guild.id)
+
     @commands.Cog.listener()
     async def on_raw_message_delete(self, payload: RawMessageDeleteEvent):
-        if payload.channel_id in self.channel_mapping:
-            message = await self.bot.db.get_message(payload.message_id)
+        await self.bot.wait_until_started()
+
+        if payload.channel_id in self.routes and payload.message_id not in self.deleted:
+            group = await self._broadcast(payload.message_id)
 
-            if not message:
+            if not group:
                 return
 
-            if message.id == message.bcid:
+            if payload.message_id == group.bcid:
                 return
 
+            group.deleted = True
+            await self.bot.db.mark_deleted([payload.message_id])
             await self.massedit(
                 payload.message_id,
                 exclude=payload.message_id,
@@ -231,6 +892,70 @@ class Core(commands.Cog):
                 embed=None,
             )
 
+    @commands.Cog.listener()
+    async def on_raw_bulk_message_delete(self, payload: RawBulkMessageDeleteEvent):
+        await self.bot.wait_until_started()
+
+        if payload.channel_id not in self.routes:
+            return
+
+        purged = [id for id in payload.message_ids if id not in self.deleted]
+        if not purged:
+            return
+
+        # A purge removes the other copies too, rather than leaving a
+        # "Message deleted." placeholder for each one
+        routes = defaultdict(list)
+        for bcid, group in (await self._broadcasts(purged)).items():
+            if bcid in payload.message_ids:
+                continue  # Originals are deleted by the relay itself
+
+            group.deleted = True
+            for sibling, channel in group.siblings():
+                if sibling not in payload.message_ids:
+                    routes[channel].append(sibling)
+                    self.deleted.set(sibling, True)
+
+        await self.bot.db.mark_deleted(purged + [m for c in routes.values() for m in c])
+
+        failures = await self._delete_routes(routes)
+        if failures:
+            logger.warning(
+                f"Failed to remove {len(failures)} copies purged from "
+                f"{payload.channel_id}: "
+                + ", ".join(f"{m} ({e.__class__.__name__})" for m, e in failures)
+            )
+
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: RawMessageUpdateEvent):
+        await self.bot.wait_until_started()
+
+        data = payload.data
+        content = data.get("content")
+
+        # Edits to our own copies and embed-only updates like link previews
+        if payload.channel_id not in self.routes or content is None:
+            return
+        if (
+            data.get("webhook_id")
+            or int(data.get("author", {}).get("id", 0)) == self.bot.user.id
+        ):
+            return
+
+        group = await self._broadcast(payload.message_id)
+        if not group or group.bcid != payload.message_id:
+            return
+
+        # Bursts of edits collapse into one revision sent after EDIT_DELAY
+        bcid = group.bcid
+        pending = bcid in self.revisions
+        self.revisions[bcid] = content
+
+        if not pending:
+            self.bot.loop.call_later(
+                EDIT_DELAY, lambda: self.bot.loop.create_task(self.revise(bcid))
+            )
+
     @commands.command(name="info")
     @commands.check_any(
         commands.is_owner(), commands.has_permissions(manage_messages=True)
@@ -240,6 +965,31 @@ class Core(commands.Cog):
 
         await ctx.reply(embed=await self._msginfo(message))
 
+    @commands.command(name="rescan")
+    @commands.check_any(level(100), commands.has_guild_permissions(manage_guild=True))
+    async def rescan(self, ctx: commands.Context, hours: int = 24, edit: bool = False):
+        """Look for recent messages this server's filter would now censor."""
+
+        ft = self.filters.get(ctx.guild.id)
+        if not ft or not ft.extra:
+            return await ctx.reply(
+                "This server's filter has no extra words to look for."
+            )
+
+        if ctx.guild.id in self.rescans:
+            return await ctx.reply("A rescan is already running for this server.")
+
+        async def run():
+            try:
+                await self._rescan(ctx, hours, edit)
+            except Exception as e:
+                logger.error(f"Rescan for {ctx.guild.id} failed: {e}")
+                await ctx.reply("The rescan failed, check the logs for details.")
+            finally:
+                del self.rescans[ctx.guild.id]
+
+        self.rescans[ctx.guild.id] = self.bot.loop.create_task(run())
+
     @commands.command(name="announce")
     @level(1000)
     async def announce(self, ctx: commands.Context, channel: str, *, message: str):
@@ -261,7 +1011,13 @@ class Core(commands.Cog):
             text="Official CrossChat Announcement",
         )
 
-        await self.broadcast(ctx.message.id, channel, embed=embed, bypass=True)
+        await self.broadcast(
+            ctx.message.id,
+            channel,
+            embed=embed,
+            bypass=True,
+            priority=Priority.ANNOUNCE,
+        )
 
 
 def setup(bot: Bot):
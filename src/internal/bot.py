@@ -1,13 +1,17 @@
 from discord.ext import commands
 from discord import Intents
 from aiohttp import ClientSession
-from typing import Optional
+from asyncio import Event, gather
+from time import perf_counter
+from typing import Awaitable, Callable, List, Optional, Tuple
 from dotenv import load_dotenv
 from loguru import logger
 from traceback import format_exc
 from os import getenv
 
-from src.utils.database import Database
+from src.utils.database import get_database
+from src.utils.scheduler import Scheduler, Priority
+from src.utils.metrics import registry, MetricsServer
 
 
 load_dotenv()
@@ -29,7 +33,63 @@ class Bot(commands.Bot):
         )
 
         self.http_session: Optional[ClientSession] = None
-        self.db = Database()
+        self.db = get_database()
+        self.scheduler = Scheduler()
+        # Metrics are opt in, so a busy port can't get in the way of logging in
+        self.metrics = MetricsServer(port=int(getenv("METRICS_PORT", 0)))
+
+        # Stages run concurrently with login once the database is connected
+        self.startup_stages: List[Tuple[str, Callable[[], Awaitable]]] = [
+            ("users", self.db.preload_users),
+            ("notifications", self.db.listen),
+            ("query plans", self.db.explain),
+        ]
+        if self.db.retention:
+            self.startup_stages.append(("retention", self.db.retention.start))
+        self.startup_times = {}
+        self.started = Event()
+
+        self.before_invoke(self.wait_until_started)
+
+        registry.gauge(
+            "crosschat_queue_depth",
+            "Outbound jobs waiting in the scheduler.",
+            lambda: [
+                ({"priority": p}, s["depth"]) for p, s in self.scheduler.stats().items()
+            ],
+        )
+        registry.gauge(
+            "crosschat_queue_latency_seconds",
+            "Average time recent outbound jobs spent queued.",
+            lambda: [
+                ({"priority": p}, s["latency_avg"])
+                for p, s in self.scheduler.stats().items()
+            ],
+        )
+        registry.gauge(
+            "crosschat_queue_dropped_total",
+            "Outbound jobs dropped because their queue was full.",
+            lambda: [
+                ({"priority": p}, s["dropped"])
+                for p, s in self.scheduler.stats().items()
+            ],
+            kind="counter",
+        )
+        for name in ("hits", "misses", "evictions"):
+            registry.gauge(
+                f"crosschat_db_cache_{name}_total",
+                f"Database cache {name}.",
+                lambda name=name: [
+                    ({"cache": "users"}, self.db.users.stats()[name]),
+                    ({"cache": "guilds"}, self.db.guilds.stats()[name]),
+                ],
+                kind="counter",
+            )
+        registry.gauge(
+            "crosschat_startup_stage_seconds",
+            "Time taken by each startup stage.",
+            lambda: [({"stage": k}, v) for k, v in self.startup_times.items()],
+        )
 
     def load_extensions(self, *exts):
         """Load a set of extensions."""
@@ -42,15 +102,75 @@ class Bot(commands.Bot):
 
         logger.info("Cog loading complete.")
 
+    def add_startup_stage(self, name: str, stage: Callable[[], Awaitable]):
+        """Register a coroutine function to run during startup.
+
+        If startup has already finished it is run straight away instead.
+        """
+        if self.started.is_set():
+            self.loop.create_task(self._run_stage(name, stage))
+        else:
+            self.startup_stages.append((name, stage))
+
+    async def _run_stage(self, name: str, stage: Callable[[], Awaitable]):
+        start = perf_counter()
+        await stage()
+        self.startup_times[name] = perf_counter() - start
+
+        logger.info(f"Startup stage {name} took {self.startup_times[name]:.3f}s")
+
+    async def startup(self):
+        """Connect to the database, then run every other stage concurrently."""
+        start = perf_counter()
+
+        try:
+            await self._run_stage("database", self.db.setup)
+
+            results = await gather(
+                *[self._run_stage(name, stage) for name, stage in self.startup_stages],
+                return_exceptions=True,
+            )
+        except Exception:
+            logger.error(f"Failed to connect to the database: {format_exc()}")
+            return await self.close()
+
+        for (name, _), result in zip(self.startup_stages, results):
+            if isinstance(result, Exception):
+                logger.error(f"Startup stage {name} failed: {result!r}")
+
+        self.started.set()
+        logger.info(f"Startup complete in {perf_counter() - start:.3f}s")
+
+    async def wait_until_started(self, *_):
+        await self.started.wait()
+
+    async def start(self, *args, **kwargs) -> None:
+        """Run startup alongside logging in and connecting to the gateway."""
+        self.loop.create_task(self.startup())
+
+        await super().start(*args, **kwargs)
+
     async def login(self, *args, **kwargs) -> None:
         """Create the aiohttp ClientSession before logging in."""
         logger.info("Logging in to Discord...")
 
         self.http_session = ClientSession()
+        await self.metrics.start()
 
         await super().login(*args, **kwargs)
 
+    async def close(self) -> None:
+        """Drain pending database writes and close sessions on shutdown."""
+        await super().close()
+        await self.scheduler.close()
+        await self.metrics.close()
+
+        if self.http_session:
+            await self.http_session.close()
+
+        await self.db.close()
+
     async def log(self, embed):
         channel = self.get_channel(int(getenv("LOGS")))
 
-        await channel.send(embed=embed)
+        return self.scheduler.submit(Priority.LOG, channel.send(embed=embed))
@@ -0,0 +1,142 @@
+from asyncio import get_event_loop
+from collections import OrderedDict
+from discord import Attachment, File
+from hashlib import sha256
+from loguru import logger
+from os import getenv
+from pathlib import Path
+from typing import Optional, Tuple
+
+from src.internal.bot import Bot
+from src.utils.cache import AsyncCache
+
+IMAGES = (".png", ".jpg", ".jpeg", ".gif", ".webp")
+
+# Discord's attachment URLs are signed and expire, so re-upload well before then
+URL_TTL = 12 * 3600
+
+
+class AttachmentStore:
+    """Relays attachments by uploading each distinct file once.
+
+    Attachments are streamed through the bot's HTTP session into a local
+    cache named by their SHA-256, which is kept under `cache_size` bytes by
+    evicting the least recently used files. Each file is uploaded once to the
+    storage channel named by ATTACHMENTS, and the URL of that upload is used
+    for every copy and for later posts of the same file.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        directory: Path = None,
+        max_size: int = None,
+        cache_size: int = None,
+    ):
+        self.bot = bot
+        self.directory = directory or Path(getenv("ATTACHMENT_DIR", "./attachments"))
+        self.max_size = max_size or int(getenv("ATTACHMENT_MAX_SIZE", 8 << 20))
+        self.cache_size = cache_size or int(getenv("ATTACHMENT_CACHE_SIZE", 512 << 20))
+        self.channel = int(getenv("ATTACHMENTS", 0))
+
+        # Keyed by (hash, extension), concurrent posts of a file share one upload
+        self.urls = AsyncCache(self._upload, maxsize=10_000, ttl=URL_TTL)
+
+        # Cached files and their sizes, least recently used first
+        self.files = OrderedDict()
+        self.usage = 0
+
+        if self.directory.exists():
+            paths = sorted(
+                self.directory.glob("*.bin"), key=lambda p: p.stat().st_mtime
+            )
+            for path in paths:
+                self._track(path.stem, path.stat().st_size)
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.channel)
+
+    def _track(self, digest: str, size: int):
+        if digest in self.files:
+            self.files.move_to_end(digest)
+            return
+
+        self.files[digest] = size
+        self.usage += size
+
+        while self.usage > self.cache_size and len(self.files) > 1:
+            old, size = self.files.popitem(last=False)
+            (self.directory / f"{old}.bin").unlink(missing_ok=True)
+            self.usage -= size
+
+    async def download(self, attachment: Attachment) -> Optional[str]:
+        """Stream an attachment into the cache, returning its hash.
+
+        Returns None if it is, or turns out to be, larger than `max_size`.
+        """
+        if attachment.size > self.max_size:
+            return None
+
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        loop = get_event_loop()
+        partial = self.directory / f"{attachment.id}.partial"
+        digest = sha256()
+        size = 0
+
+        try:
+            with open(partial, "wb") as f:
+                async with self.bot.http_session.get(attachment.url) as resp:
+                    resp.raise_for_status()
+
+                    async for chunk in resp.content.iter_chunked(1 << 16):
+                        size += len(chunk)
+                        if size > self.max_size:
+                            break
+
+                        digest.update(chunk)
+                        await loop.run_in_executor(None, f.write, chunk)
+        except Exception:
+            partial.unlink(missing_ok=True)
+            raise
+
+        if size > self.max_size:
+            partial.unlink(missing_ok=True)
+            return None
+
+        name = digest.hexdigest()
+        partial.replace(self.directory / f"{name}.bin")
+        self._track(name, size)
+
+        return name
+
+    async def _upload(self, key: Tuple[str, str]) -> Optional[str]:
+        digest, extension = key
+        channel = self.bot.get_channel(self.channel)
+
+        try:
+            message = await channel.send(
+                file=File(self.directory / f"{digest}.bin", f"{digest[:16]}{extension}")
+            )
+        except Exception as e:
+            logger.warning(f"Failed to upload attachment {digest}: {e}")
+            return None
+
+        return message.attachments[0].url
+
+    async def url(self, attachment: Attachment) -> Optional[str]:
+        """Get a URL for the attachment that will outlive the original message."""
+        if not self.enabled:
+            return None
+
+        try:
+            digest = await self.download(attachment)
+        except Exception as e:
+            logger.warning(f"Failed to download attachment {attachment.id}: {e}")
+            return None
+
+        if digest is None:
+            return None
+
+        return await self.urls.get((digest, Path(attachment.filename).suffix.lower()))
@@ -0,0 +1,149 @@
+from asyncio import CancelledError, Future, get_event_loop, shield
+from collections import OrderedDict
+from time import monotonic
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class LRU:
+    """A small least-recently-used mapping with a fixed capacity."""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if key not in self.items:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def set(self, key: Hashable, value: Any):
+        self.items[key] = value
+        self.items.move_to_end(key)
+
+        if len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        return self.items.pop(key, default)
+
+    def clear(self):
+        self.items.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.items
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+class AsyncCache:
+    """A bounded LRU cache with expiry for values loaded by a coroutine.
+
+    Concurrent misses for the same key share a single call to `load`. A load
+    returning None is cached too, for the shorter `negative_ttl`.
+    """
+
+    def __init__(
+        self,
+        load: Callable[[Hashable], Awaitable[Any]],
+        maxsize: int = 10_000,
+        ttl: float = 600,
+        negative_ttl: float = 60,
+    ):
+        self.load = load
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+        self.items = OrderedDict()
+        self.loading: Dict[Hashable, Future] = {}
+        self.stale = set()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get(self, key: Hashable) -> Any:
+        entry = self.items.get(key)
+
+        if entry is not None:
+            expires, value = entry
+            if expires > monotonic():
+                self.hits += 1
+                self.items.move_to_end(key)
+                return value
+            del self.items[key]
+
+        self.misses += 1
+
+        while key in self.loading:
+            loading = self.loading[key]
+            try:
+                return await shield(loading)
+            except CancelledError:
+                if not loading.cancelled():
+                    raise  # This caller was cancelled, not the load
+                # The caller doing the load was cancelled, load again here
+
+        future = get_event_loop().create_future()
+        self.loading[key] = future
+
+        try:
+            value = await self.load(key)
+        except CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # Waiters get it, don't warn if there are none
+            raise
+        finally:
+            self.loading.pop(key, None)
+
+        # Don't cache a value that was invalidated while it was loading
+        if key in self.stale:
+            self.stale.discard(key)
+        else:
+            self.set(key, value)
+        future.set_result(value)
+
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        ttl = self.ttl if value is not None else self.negative_ttl
+
+        self.items[key] = (monotonic() + ttl, value)
+        self.items.move_to_end(key)
+
+        while len(self.items) > self.maxsize:
+            self.items.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key: Hashable):
+        self.items.pop(key, None)
+
+        if key in self.loading:
+            self.stale.add(key)
+
+    def clear(self):
+        self.items.clear()
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.items
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -1,166 +1,554 @@
-from asyncio import get_event_loop
-from asyncpg import create_pool
+from asyncio import get_event_loop, Lock, sleep
+from asyncpg import create_pool, connect, UniqueViolationError
 from os import getenv
 from loguru import logger
 from json import dumps, loads
 from discord import Message as Msg
 from collections import namedtuple
 from datetime import datetime
+from time import monotonic
+from typing import AsyncIterator, Callable, Dict, List, Tuple
+
+from src.utils.migrations import migrate, explain
+from src.utils.cache import AsyncCache
+from src.utils.retention import Retention
 
 Guild = namedtuple("Guild", ["id", "config", "created_at"])
 User = namedtuple("User", ["id", "permissions", "banned", "created_at"])
+
+# Published by triggers on Users and Guilds, see static/migrations
+INVALIDATE = "crosschat_invalidate"
 Message = namedtuple(
     "Message",
-    ["id", "bcid", "guild_id", "channel_id", "author_id", "content", "deleted"],
+    [
+        "id",
+        "bcid",
+        "guild_id",
+        "channel_id",
+        "author_id",
+        "content",
+        "deleted",
+        "attachments",
+    ],
+    defaults=[()],
 )
 
 
+def to_message(data) -> Message:
+    """Build a Message from a row, decoding its attachments."""
+    attachments = data["attachments"]
+    return Message(
+        data["id"],
+        data["bcid"],
+        data["guild_id"],
+        data["channel_id"],
+        data["author_id"],
+        data["content"],
+        data["deleted"],
+        loads(attachments) if attachments else (),
+    )
+
+
+def from_archive(row: list) -> Message:
+    # Archives written before attachments were stored have one column less
+    attachments = row[7] if len(row) > 7 else None
+    return Message(*row[:7], loads(attachments) if attachments else ())
+
+
+class MessageBuffer:
+    """Buffers message rows and writes them to the database in batches.
+
+    Rows are flushed once `size` of them are pending or `delay` seconds after
+    the first one was added, whichever comes first. A failed batch is put
+    back and retried with backoff, and after `retries` failures in a row it
+    is inserted row by row instead, skipping IDs that already exist.
+    """
+
+    COLUMNS = [
+        "id",
+        "bcid",
+        "guild_id",
+        "channel_id",
+        "author_id",
+        "content",
+        "attachments",
+    ]
+
+    def __init__(
+        self,
+        db: "Database",
+        size: int = 100,
+        delay: float = 1.0,
+        retries: int = 3,
+        limit: int = 50_000,
+    ):
+        self.db = db
+        self.size = size
+        self.delay = delay
+        self.retries = retries
+        self.limit = limit
+
+        self.rows = []
+        self.lock = Lock()
+        self.timer = None
+
+        self.failures = 0
+        self.retry_at = 0.0
+
+    @property
+    def pending(self) -> bool:
+        return bool(self.rows) or self.lock.locked()
+
+    def _schedule(self, delay: float):
+        if self.timer is None:
+            loop = get_event_loop()
+            self.timer = loop.call_later(delay, lambda: loop.create_task(self.flush()))
+
+    async def add(self, row: tuple):
+        self.rows.append(row)
+
+        if len(self.rows) >= self.size and not self.failures:
+            await self.flush()
+        else:
+            self._schedule(self.delay)
+
+    async def _write(self, rows: List[tuple]):
+        if self.failures < self.retries:
+            await self.db.write_messages(rows)
+        else:
+            # The batch may be failing on a single conflicting row
+            await self.db.insert_messages(rows)
+
+    async def flush(self, force: bool = False):
+        """Write pending rows, unless backing off from a failure and not `force`."""
+        if self.failures and not force and monotonic() < self.retry_at:
+            return
+
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+
+        async with self.lock:
+            rows, self.rows = self.rows, []
+            if not rows:
+                return
+
+            try:
+                await self._write(rows)
+                self.failures = 0
+                return
+            except Exception as e:
+                self.failures += 1
+                logger.error(
+                    f"Failed to write {len(rows)} messages "
+                    f"(attempt {self.failures}): {e!r}"
+                )
+
+            self.rows[:0] = rows
+            if len(self.rows) > self.limit:
+                dropped = len(self.rows) - self.limit
+                del self.rows[:dropped]
+                logger.error(f"Dropped {dropped} buffered messages over the limit")
+
+            delay = min(self.delay * 2**self.failures, 60)
+            self.retry_at = monotonic() + delay
+            self._schedule(delay)
+
+
 class Database:
-    """A database interface for the bot to connect to Postgres."""
+    """Caching, buffering and the Guild/User/Message API shared by every backend.
+
+    Backends implement `setup`, the query helpers and `write_messages`.
+    Queries are written for Postgres with $n placeholders, which SQLite also
+    understands once translated.
+    """
 
     def __init__(self):
-        self.guilds = {}
-        self.users = {}
+        # Changes are pushed to `invalidate`, so entries can live a long time
+        self.guilds = AsyncCache(self._load_guild, maxsize=5_000, ttl=3600)
+        self.users = AsyncCache(self._load_user, maxsize=50_000, ttl=3600)
+        self.messages = MessageBuffer(self)
+        self.retention = None
 
-        loop = get_event_loop()
-        loop.run_until_complete(self.setup())
+        self.subscribers: List[Callable[[str, int], None]] = []
 
     async def setup(self):
-        logger.info("Setting up database connections...")
-        self.pool = await create_pool(
-            host=getenv("DB_HOST", "127.0.0.1"),
-            port=int(getenv("DB_PORT", 5432)),
-            database=getenv("DB_DATABASE", "crosschat"),
-            user=getenv("DB_USER", "root"),
-            password=getenv("DB_PASS", "password"),
-        )
-        logger.info("Database setup complete.")
+        raise NotImplementedError
+
+    async def close(self):
+        """Write any buffered messages."""
+        await self.messages.flush(force=True)
+
+        if self.messages.timer:
+            self.messages.timer.cancel()
+        if self.messages.rows:
+            logger.error(f"Lost {len(self.messages.rows)} unwritten messages")
+
+    async def listen(self):
+        """Start receiving invalidations from other processes, if there can be any."""
+
+    async def explain(self):
+        """Log query plans for the hot queries, if the backend supports it."""
 
     async def execute(self, query: str, *args):
-        async with self.pool.acquire() as conn:
-            await conn.execute(query, *args)
+        raise NotImplementedError
 
     async def fetchrow(self, query: str, *args):
-        async with self.pool.acquire() as conn:
-            return await conn.fetchrow(query, *args)
+        raise NotImplementedError
 
     async def fetch(self, query: str, *args):
-        async with self.pool.acquire() as conn:
-            return await conn.fetch(query, *args)
+        raise NotImplementedError
+
+    def stream(self, query: str, *args, size: int = 1000) -> AsyncIterator[list]:
+        """Yield the rows of a query in batches without loading them all at once."""
+        raise NotImplementedError
+
+    async def write_messages(self, rows: List[tuple]):
+        """Insert rows of MessageBuffer.COLUMNS in one batch."""
+        raise NotImplementedError
+
+    async def insert_messages(self, rows: List[tuple]):
+        """Insert rows one at a time, skipping any whose ID already exists."""
+        await self.write_messages(rows)
+
+    # Cache invalidation
+    def subscribe(self, callback: Callable[[str, int], None]):
+        """Call `callback(table, id)` whenever a Users or Guilds row changes.
+
+        The table is "*" with an ID of 0 when anything could have changed.
+        """
+        self.subscribers.append(callback)
+
+    def invalidate(self, table: str, id: int):
+        if table == "users":
+            self.users.pop(id)
+        elif table == "guilds":
+            self.guilds.pop(id)
+        elif table == "*":
+            self.users.clear()
+            self.guilds.clear()
+
+        for callback in self.subscribers:
+            try:
+                callback(table, id)
+            except Exception as e:
+                logger.error(f"Invalidation subscriber failed: {e}")
 
     # Guild Coros
-    async def get_guild(self, guild_id: int):
-        if guild_id in self.guilds:
-            return self.guilds[guild_id]
-
+    async def _load_guild(self, guild_id: int):
         data = await self.fetchrow("SELECT * FROM Guilds WHERE id = $1;", guild_id)
 
         if not data:
-            return await self.create_guild(guild_id)
+            return None
 
-        guild = Guild(data["id"], loads(data["config"]), data["created_at"])
-        self.guilds[guild_id] = guild
+        return Guild(data["id"], data["config"], data["created_at"])
+
+    async def get_guild(self, guild_id: int):
+        guild = await self.guilds.get(guild_id)
+
+        if not guild:
+            # Unknown guilds get a default config, the row is created on first update
+            return Guild(guild_id, {}, datetime.utcnow())
 
         return guild
 
-    async def create_guild(self, guild_id: int, config: dict = {}):
+    async def create_guild(self, guild_id: int, config: dict = None):
+        config = config or {}
+
         await self.execute(
-            "INSERT INTO Guilds (id, config) VALUES ($1, $2);", guild_id, dumps(config)
+            "INSERT INTO Guilds (id, config) VALUES ($1, $2) ON CONFLICT (id) DO NOTHING;",
+            guild_id,
+            config,
         )
-        self.guilds.pop(guild_id, None)  # Shouldn't be needed, but I want to make sure
+        self.guilds.pop(guild_id)
 
         return Guild(guild_id, config, datetime.utcnow())
 
     async def update_guild(self, guild_id: int, config: dict):
         await self.execute(
-            "UPDATE Guilds SET config = $2 WHERE id = $1;", guild_id, dumps(config)
+            "INSERT INTO Guilds (id, config) VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET config = EXCLUDED.config;",
+            guild_id,
+            config,
         )
-        self.guilds.pop(guild_id, None)  # Clear the cache
+        self.guilds.pop(guild_id)  # Clear the cache
 
     async def get_all_guilds(self):
         guilds = await self.fetch("SELECT * FROM Guilds;")
 
         gs = []
         for data in guilds:
-            gs.append(Guild(data["id"], loads(data["config"]), data["created_at"]))
+            guild = Guild(data["id"], data["config"], data["created_at"])
+            self.guilds.set(guild.id, guild)
+            gs.append(guild)
 
         return gs
 
     # User coros
-    async def get_user(self, user_id: int):
-        if user_id in self.users:
-            return self.users[user_id]
-
+    async def _load_user(self, user_id: int):
         data = await self.fetchrow("SELECT * FROM Users WHERE id = $1;", user_id)
 
         if not data:
-            return await self.create_user(user_id)
+            # Create the row on first sight so users can be banned by hand, loads
+            # are single flight so this is one INSERT per user
+            await self.execute(
+                "INSERT INTO Users (id) VALUES ($1) ON CONFLICT (id) DO NOTHING;",
+                user_id,
+            )
+            return User(user_id, 0, False, datetime.utcnow())
 
-        user = User(data["id"], data["permissions"], data["banned"], data["created_at"])
-        self.users[user_id] = user
+        return User(data["id"], data["permissions"], data["banned"], data["created_at"])
 
-        return user
+    async def get_user(self, user_id: int) -> User:
+        return await self.users.get(user_id)
 
     async def create_user(self, user_id: int):
-        await self.execute("INSERT INTO Users (id) VALUES ($1);", user_id)
-        self.users.pop(user_id, None)  # Shouldn't be needed, but I want to make sure
+        await self.execute(
+            "INSERT INTO Users (id) VALUES ($1) ON CONFLICT (id) DO NOTHING;", user_id
+        )
+        self.users.pop(user_id)
 
         return User(user_id, 0, False, datetime.utcnow())
 
+    async def preload_users(self) -> int:
+        """Cache every privileged or banned user in a single query."""
+        users = await self.fetch("SELECT * FROM Users WHERE permissions > 0 OR banned;")
+
+        for data in users:
+            user = User(
+                data["id"], data["permissions"], data["banned"], data["created_at"]
+            )
+            self.users.set(user.id, user)
+
+        return len(users)
+
     async def update_user_permissions(self, user_id: int, level: int):
         await self.execute(
-            "UPDATE Users SET permissions = $2 WHERE id = $1;", user_id, level
+            "INSERT INTO Users (id, permissions) VALUES ($1, $2) ON CONFLICT (id) DO UPDATE SET permissions = EXCLUDED.permissions;",
+            user_id,
+            level,
         )
-        self.users.pop(user_id, None)  # Clear the cache
+        self.users.pop(user_id)  # Clear the cache
 
     # Message coros
-    async def create_message(self, message: Msg, bcid: int):
+    async def create_message(
+        self, message: Msg, bcid: int, attachments: List[Tuple[str, str]] = None
+    ):
+        """Store a message, with the (filename, url) of its relayed attachments."""
         id = message.id
         guild_id = message.guild.id
         channel_id = message.channel.id
         author_id = message.author.id
-        content = message.content
+
+        # Content and attachments are only kept on the original
+        content = message.content if id == bcid else None
+        attachments = dumps(attachments) if attachments and id == bcid else None
+
+        await self.messages.add(
+            (id, bcid, guild_id, channel_id, author_id, content, attachments)
+        )
+
+    async def update_message_content(self, id: int, content: str):
+        if self.messages.pending:
+            await self.messages.flush()
 
         await self.execute(
-            "INSERT INTO Messages (id, bcid, guild_id, channel_id, author_id, content) VALUES ($1, $2, $3, $4, $5, $6);",
-            id,
-            bcid,
-            guild_id,
-            channel_id,
-            author_id,
-            content,
+            "UPDATE Messages SET content = $2 WHERE id = $1;", id, content
         )
 
-    async def get_message(self, id: int):
+    async def get_message(self, id: int, archived: bool = False):
+        """Get a message by ID, optionally searching archived partitions too."""
+        if self.messages.pending:
+            await self.messages.flush()
+
         data = await self.fetchrow("SELECT * FROM Messages WHERE id = $1;", id)
 
         if not data:
+            if archived and self.retention and (row := await self.retention.find(id)):
+                return from_archive(row)
             return None
 
-        return Message(
-            data["id"],
-            data["bcid"],
-            data["guild_id"],
-            data["channel_id"],
-            data["author_id"],
-            data["content"],
-            data["deleted"],
-        )
+        return to_message(data)
+
+    async def get_messages(self, bcid: int, archived: bool = False):
+        if self.messages.pending:
+            await self.messages.flush()
 
-    async def get_messages(self, bcid: int):
         messages = await self.fetch("SELECT * FROM Messages WHERE bcid = $1;", bcid)
 
-        ms = []
-        for data in messages:
-            ms.append(
-                Message(
-                    data["id"],
-                    data["bcid"],
-                    data["guild_id"],
-                    data["channel_id"],
-                    data["author_id"],
-                    data["content"],
-                    data["deleted"],
+        if not messages and archived and self.retention:
+            rows = await self.retention.find_broadcast(bcid)
+            return [from_archive(row) for row in rows]
+
+        return [to_message(data) for data in messages]
+
+    async def get_broadcasts(self, ids: List[int]) -> Dict[int, List[Message]]:
+        """Get every row of the broadcasts the given messages belong to, by bcid."""
+        if self.messages.pending:
+            await self.messages.flush()
+
+        rows = await self.fetch(
+            "SELECT * FROM Messages WHERE bcid IN "
+            "(SELECT bcid FROM Messages WHERE id = ANY($1));",
+            ids,
+        )
+
+        broadcasts = {}
+        for data in rows:
+            broadcasts.setdefault(data["bcid"], []).append(to_message(data))
+        return broadcasts
+
+    async def mark_deleted(self, ids: List[int]):
+        if self.messages.pending:
+            await self.messages.flush()
+
+        await self.execute(
+            "UPDATE Messages SET deleted = TRUE WHERE id = ANY($1);", ids
+        )
+
+
+class PostgresDatabase(Database):
+    """A database backed by a Postgres connection pool."""
+
+    def __init__(self):
+        super().__init__()
+        self.retention = Retention(self)
+        self.listener = None
+        self.pool = None
+
+    @staticmethod
+    def credentials() -> dict:
+        return dict(
+            host=getenv("DB_HOST", "127.0.0.1"),
+            port=int(getenv("DB_PORT", 5432)),
+            database=getenv("DB_DATABASE", "crosschat"),
+            user=getenv("DB_USER", "root"),
+            password=getenv("DB_PASS", "password"),
+        )
+
+    async def setup(self):
+        logger.info("Setting up database connections...")
+        self.pool = await create_pool(**self.credentials(), init=self.init_connection)
+
+        await migrate(self.pool)
+
+        # Without a partition covering today, every write would fail
+        await self.retention.prepare()
+
+        logger.info("Database setup complete.")
+
+    async def explain(self):
+        await explain(self.pool)
+
+    async def listen(self):
+        """Listen for invalidations on a dedicated connection."""
+        self.listener = await connect(**self.credentials())
+        self.listener.add_termination_listener(self._on_terminate)
+        await self.listener.add_listener(INVALIDATE, self._on_notify)
+
+        logger.info("Listening for cache invalidations.")
+
+    def _on_notify(self, conn, pid: int, channel: str, payload: str):
+        event = loads(payload)
+        self.invalidate(event["table"], event["id"])
+
+    def _on_terminate(self, conn):
+        if self.listener is None:
+            return  # Closed on purpose
+
+        logger.warning("Lost the invalidation connection, reconnecting...")
+        get_event_loop().create_task(self._reconnect())
+
+    async def _reconnect(self):
+        delay = 1
+        while True:
+            try:
+                await self.listen()
+                break
+            except Exception as e:
+                logger.error(f"Failed to reconnect the invalidation listener: {e}")
+                await sleep(delay)
+                delay = min(delay * 2, 60)
+
+        # Anything could have changed while we weren't listening
+        self.invalidate("*", 0)
+
+    @staticmethod
+    async def init_connection(conn):
+        await conn.set_type_codec(
+            "jsonb", encoder=dumps, decoder=loads, schema="pg_catalog"
+        )
+
+    async def close(self):
+        """Write any buffered messages and close the pool."""
+        if self.listener:
+            listener, self.listener = self.listener, None
+            await listener.close()
+
+        # Setup may have failed before the pool was created
+        if self.pool is None:
+            return
+
+        await super().close()
+        pool, self.pool = self.pool, None
+        await pool.close()
+
+    async def execute(self, query: str, *args):
+        async with self.pool.acquire() as conn:
+            await conn.execute(query, *args)
+
+    async def fetchrow(self, query: str, *args):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow(query, *args)
+
+    async def fetch(self, query: str, *args):
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(query, *args)
+
+    async def stream(self, query: str, *args, size: int = 1000):
+        # Server side cursors only live inside a transaction
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                batch = []
+                async for row in conn.cursor(query, *args, prefetch=size):
+                    batch.append(row)
+                    if len(batch) >= size:
+                        yield batch
+                        batch = []
+
+                if batch:
+                    yield batch
+
+    async def write_messages(self, rows: List[tuple]):
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.copy_records_to_table(
+                    "messages", records=rows, columns=MessageBuffer.COLUMNS
                 )
+        except UniqueViolationError:
+            # COPY is all or nothing, a retry would hit the same row again
+            await self.insert_messages(rows)
+
+    async def insert_messages(self, rows: List[tuple]):
+        columns = ", ".join(MessageBuffer.COLUMNS)
+        values = ", ".join(f"${i + 1}" for i in range(len(MessageBuffer.COLUMNS)))
+
+        async with self.pool.acquire() as conn:
+            await conn.executemany(
+                f"INSERT INTO Messages ({columns}) VALUES ({values}) "
+                "ON CONFLICT (id) DO NOTHING;",
+                rows,
             )
-        return ms
+
+
+def get_database() -> Database:
+    """Create the backend named by DB_BACKEND, either postgres or sqlite."""
+    backend = getenv("DB_BACKEND", "postgres").lower()
+
+    if backend == "postgres":
+        return PostgresDatabase()
+    if backend == "sqlite":
+        from src.utils.sqlite import SQLiteDatabase
+
+        return SQLiteDatabase()
+
+    raise ValueError(f"Unknown database backend {backend!r}")
@@ -1,36 +1,36 @@
-from re import compile, IGNORECASE
+from re import compile, IGNORECASE, Match
 from discord import Emoji
 
 from src.internal.bot import Bot
 
-EMOJI = compile(r"<a?:\w{2,32}:\d{17,20}>", IGNORECASE)
-NAME = compile(r"[^ :]{2,32}", IGNORECASE)
-ID = compile(r"\d*")
+EMOJI = compile(r"<a?:(\w{2,32}):(\d{17,20})>", IGNORECASE)
 
 
 class EmojiFixer:
     def __init__(self, bot: Bot):
         self.bot = bot
 
-    def message(self, content: str):
-        botems = {emoji.id for emoji in self.bot.emojis}
+        self.ids = set()
+        self.names = {}
+
+    def rebuild(self):
+        """Rebuild the emoji indexes from the bot's emoji cache."""
+        self.ids = {emoji.id for emoji in self.bot.emojis}
 
-        ems = []
-        for emoji in EMOJI.finditer(content):
-            e = emoji.group()
-            name = NAME.search(e)
-            _id = ID.search(e).group()
+        names = {}
+        for emoji in self.bot.emojis:
+            names.setdefault(emoji.name.lower(), emoji)
+        self.names = names
 
-            if _id in botems:
-                continue
+    def _replace(self, match: Match) -> str:
+        if int(match.group(2)) in self.ids:
+            return match.group()
 
-            for em in self.bot.emojis:
-                em: Emoji
-                if em.name.lower() == name.group().lower():
-                    ems.append((e, f"<{'a' if em.animated else ''}:{em.name}:{em.id}>"))
-                    break
+        em: Emoji = self.names.get(match.group(1).lower())
+        if not em:
+            return match.group()
 
-        for e in ems:
-            content = content.replace(e[0], e[1])
+        return f"<{'a' if em.animated else ''}:{em.name}:{em.id}>"
 
-        return content
+    def message(self, content: str):
+        return EMOJI.sub(self._replace, content)
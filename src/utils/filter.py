@@ -1,46 +1,179 @@
 from normalize import normalize
-from collections import namedtuple
-from re import sub, IGNORECASE, compile
+from collections import namedtuple, deque
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
+
+from src.utils.cache import LRU
 
 Result = namedtuple("Result", ["message", "changed", "tokens"])
 LETTERS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+DIGITS = "0123456789"
+BOUNDARY = " "
+
+
+@lru_cache(maxsize=4096)
+def fold(char: str) -> str:
+    """Fold a single character into the filter alphabet.
+
+    Lookalikes are normalized and lowercased, whitespace becomes a token
+    boundary and anything else folds to an empty string and is skipped.
+    """
+    if char.isspace():
+        return BOUNDARY
+    return "".join(l for l in normalize(char).lower() if l in LETTERS or l in DIGITS)
+
+
+def fold_word(word: str) -> str:
+    return BOUNDARY.join(
+        "".join(fold(c) for c in part) for part in word.lower().split()
+    )
+
+
+class Automaton:
+    """An Aho-Corasick automaton matching whole tokens in a single pass."""
+
+    def __init__(self, words: Iterable[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.out: List[Tuple[Tuple[str, int], ...]] = [()]
+
+        for word in words:
+            pattern = fold_word(word)
+            if pattern:
+                self._insert(f"{BOUNDARY}{pattern}{BOUNDARY}", word)
+
+        self._link()
+
+    def _insert(self, pattern: str, word: str):
+        node = 0
+        for char in pattern:
+            nxt = self.goto[node].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][char] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(())
+            node = nxt
+        self.out[node] += ((word, len(pattern)),)
+
+    def _link(self):
+        queue = deque(self.goto[0].values())
+
+        while queue:
+            node = queue.popleft()
+            for char, child in self.goto[node].items():
+                queue.append(child)
+
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(char, 0)
+                if self.fail[child] == child:
+                    self.fail[child] = 0
+                self.out[child] += self.out[self.fail[child]]
+
+    def __call__(self, message: str) -> Result:
+        return search((self,), message)
+
+
+def search(automata: Tuple[Automaton, ...], message: str) -> Result:
+    """Run several automata over a message in one pass, merging their matches."""
+    tables = [(a.goto, a.fail, a.out) for a in automata]
+    nodes = [goto[0].get(BOUNDARY, 0) for goto, _, _ in tables]
+
+    # Walk the folded message, remembering which original character each
+    # folded character came from so matches can be masked in place.
+    positions = [-1]
+    spans = []
+    tokens = []
+
+    for index, char in enumerate(f"{message}{BOUNDARY}"):
+        folded = fold(char)
+        for letter in folded:
+            if letter == BOUNDARY and positions[-1] == -1:
+                continue  # Collapse runs of whitespace
+
+            positions.append(-1 if letter == BOUNDARY else index)
+            end = len(positions) - 2
+
+            for i, (goto, fail, out) in enumerate(tables):
+                node = nodes[i]
+                while node and letter not in goto[node]:
+                    node = fail[node]
+                node = nodes[i] = goto[node].get(letter, 0)
+
+                for word, length in out[node]:
+                    spans.append((positions[end - length + 3], positions[end]))
+                    if word not in tokens:
+                        tokens.append(word)
+
+    if not spans:
+        return Result(message, False, tokens)
+
+    chars = list(message)
+    for start, end in spans:
+        for i in range(start, end + 1):
+            if not chars[i].isspace():
+                chars[i] = "#"
+
+    return Result("".join(chars), True, tokens)
+
 
 with open("./static/words.txt") as f:
     init_words = set([word.strip() for word in f.readlines()])
 
+base_automaton = Automaton(init_words)
+
+# Recent results keyed by (fingerprint, message), shared by every filter
+results = LRU(2048)
+
 
 class MessageFilter:
-    def __init__(self, words: str):
-        self.words = set([word.lower() for word in words]) | init_words
+    def __init__(self, words: Iterable[str]):
+        self.extra = set([word.lower() for word in words]) - init_words
+        self.compile()
+
+    @property
+    def words(self) -> set:
+        return self.extra | init_words
+
+    @staticmethod
+    def expand(words: Iterable[str]) -> set:
+        """The full word set a filter built from `words` would use."""
+        return set([word.lower() for word in words]) | init_words
+
+    def compile(self):
+        """Build a small automaton for the extra words, run alongside the base one."""
+        self.fingerprint = frozenset(self.extra)
+
+        if self.extra:
+            self.automata = (base_automaton, Automaton(self.extra))
+        else:
+            self.automata = (base_automaton,)
 
     def add(self, word: str) -> bool:
         if word.lower() in self.words:
             return False
-        self.words.add(word.lower())
+        self.extra.add(word.lower())
+        self.compile()
         return True
 
     def remove(self, word: str) -> bool:
         if word.lower() in init_words:
             return False
-        if word.lower() in self.words:
-            self.words.remove(word.lower())
+        if word.lower() in self.extra:
+            self.extra.remove(word.lower())
+            self.compile()
             return True
         return False
 
     def __call__(self, message: str) -> Result:
-        check = normalize(message).lower()
-        changed = False
-
-        check = "".join([l for l in check if l in LETTERS])
-
-        check = check.split(" ")
-
-        tokens = []
+        key = (self.fingerprint, message)
+        result = results.get(key)
 
-        for word in self.words:
-            if word in check:
-                message = sub(word, "#" * len(word), message, IGNORECASE)
-                changed = True
-                tokens.append(word)
+        if result is None:
+            result = search(self.automata, message)
+            results.set(key, result)
 
-        return Result(message, changed, tokens)
+        return result
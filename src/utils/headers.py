@@ -0,0 +1,43 @@
+from collections import namedtuple
+from discord import Member
+
+from src.utils.cache import LRU
+
+Header = namedtuple("Header", ["name", "colour", "icon_url", "footer"])
+
+
+class HeaderCache(LRU):
+    """Rendered embed author details per (guild ID, member ID).
+
+    Entries are dropped when something they were rendered from changes, so a
+    relay only has to assemble the cached fields.
+    """
+
+    def render(self, member: Member, badge: str) -> Header:
+        key = (member.guild.id, member.id)
+        header = self.get(key)
+
+        if header is None:
+            header = Header(
+                name=f"{member} {badge}",
+                colour=member.colour.value,
+                icon_url=str(member.avatar_url),
+                footer=f"{member.id} • {member.guild.name}",
+            )
+            self.set(key, header)
+
+        return header
+
+    def _discard(self, match):
+        for key in [key for key in self.items if match(key)]:
+            del self.items[key]
+
+    def member(self, guild_id: int, member_id: int):
+        self.pop((guild_id, member_id))
+
+    def user(self, user_id: int):
+        """Drop a user's headers in every guild."""
+        self._discard(lambda key: key[1] == user_id)
+
+    def guild(self, guild_id: int):
+        self._discard(lambda key: key[0] == guild_id)
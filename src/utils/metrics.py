@@ -0,0 +1,168 @@
+from aiohttp import web
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from loguru import logger
+from time import perf_counter
+from typing import Callable, Dict, Iterable, Tuple
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(labels: Iterable[Tuple[str, str]]) -> str:
+    labels = list(labels)
+    if not labels:
+        return ""
+    escaped = (
+        f'{k}="' + str(v).replace("\\", "\\\\").replace('"', '\\"') + '"'
+        for k, v in labels
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values = defaultdict(float)
+
+    def inc(self, amount: float = 1, **labels):
+        self.values[tuple(sorted(labels.items()))] += amount
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_labels(labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        if key not in self.values:
+            # One slot per bucket plus +Inf, then the sum
+            self.values[key] = [0] * (len(self.buckets) + 2)
+
+        counts = self.values[key]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Time the body of a `with` block as a single observation."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(perf_counter() - start, **labels)
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, counts in self.values.items():
+            total = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                total += count
+                le = _labels((*labels, ("le", bound)))
+                yield f"{self.name}_bucket{le} {total}"
+            yield f"{self.name}_sum{_labels(labels)} {counts[-1]}"
+            yield f"{self.name}_count{_labels(labels)} {total}"
+
+
+class Gauge:
+    """A metric read from a callback returning (labels, value) pairs at scrape time.
+
+    Use `kind="counter"` for values that only go up, like hit counts kept
+    elsewhere.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        read: Callable[[], Iterable[tuple]],
+        kind: str = "gauge",
+    ):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.kind = kind
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} {self.kind}"
+        for labels, value in self.read():
+            yield f"{self.name}{_labels(sorted(labels.items()))} {value}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, help))
+
+    def histogram(self, name: str, help: str, **kwargs) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, help, **kwargs))
+
+    def gauge(self, name: str, help: str, read: Callable, **kwargs) -> Gauge:
+        self.metrics[name] = Gauge(name, help, read, **kwargs)
+        return self.metrics[name]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"Failed to render metric {metric.name}: {e}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class MetricsServer:
+    """Serves the registry as Prometheus text on a local port.
+
+    Disabled when `port` is 0. Failing to bind is logged rather than raised,
+    metrics must never stop the bot from relaying.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0):
+        self.host = host
+        self.port = port
+        self.runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain")
+
+    async def start(self):
+        if not self.port:
+            return
+
+        app = web.Application()
+        app.router.add_get("/metrics", self.handle)
+
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+
+        try:
+            await web.TCPSite(self.runner, self.host, self.port).start()
+        except OSError as e:
+            logger.error(f"Not serving metrics, couldn't bind port {self.port}: {e}")
+            await self.close()
+            return
+
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+
+    async def close(self):
+        if self.runner:
+            runner, self.runner = self.runner, None
+            await runner.cleanup()
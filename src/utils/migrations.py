@@ -0,0 +1,85 @@
+from asyncpg import Pool
+from loguru import logger
+from pathlib import Path
+
+INIT = Path("./static/init.sql")
+MIGRATIONS = Path("./static/migrations")
+
+# Arbitrary key so that only one process migrates at a time
+LOCK = 0x63636D69
+
+# Queries on the relay hot path, with a placeholder argument for EXPLAIN
+HOT_QUERIES = [
+    ("SELECT * FROM Messages WHERE id = $1;", 0),
+    ("SELECT * FROM Messages WHERE bcid = $1;", 0),
+    ("SELECT * FROM Messages WHERE author_id = $1;", 0),
+    ("SELECT * FROM Users WHERE id = $1;", 0),
+    ("SELECT * FROM Guilds WHERE id = $1;", 0),
+]
+
+# Sequential scans are expected on tiny tables, only complain past this size
+SEQSCAN_ROWS = 10_000
+
+
+def pending(applied: set) -> list:
+    """Return (version, name, path) for each migration not yet applied."""
+    migrations = []
+
+    for path in sorted(MIGRATIONS.glob("*.sql")):
+        version, _, name = path.stem.partition("_")
+        if int(version) not in applied:
+            migrations.append((int(version), name, path))
+
+    return migrations
+
+
+async def migrate(pool: Pool):
+    """Create the base schema and apply any outstanding migrations in order."""
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("SELECT pg_advisory_xact_lock($1);", LOCK)
+
+            await conn.execute(INIT.read_text())
+            await conn.execute("""CREATE TABLE IF NOT EXISTS Migrations (
+                    version     INT NOT NULL PRIMARY KEY,
+                    name        TEXT NOT NULL,
+                    applied_at  TIMESTAMP NOT NULL DEFAULT NOW()
+                );""")
+
+            applied = {
+                row["version"]
+                for row in await conn.fetch("SELECT version FROM Migrations;")
+            }
+
+            for version, name, path in pending(applied):
+                logger.info(f"Applying migration {version}: {name}")
+
+                await conn.execute(path.read_text())
+                await conn.execute(
+                    "INSERT INTO Migrations (version, name) VALUES ($1, $2);",
+                    version,
+                    name,
+                )
+
+
+async def explain(pool: Pool):
+    """Log the query plans of the hot queries, warning on sequential scans."""
+    async with pool.acquire() as conn:
+        for query, arg in HOT_QUERIES:
+            rows = await conn.fetch(f"EXPLAIN {query}", arg)
+            plan = "\n".join(row[0] for row in rows)
+
+            logger.info(f"Query plan for {query}\n{plan}")
+
+            if "Seq Scan" not in plan:
+                continue
+
+            table = query.split("FROM ")[1].split()[0].lower()
+            size = await conn.fetchval(
+                "SELECT reltuples FROM pg_class WHERE relname = $1;", table
+            )
+
+            if size and size > SEQSCAN_ROWS:
+                logger.warning(
+                    f"Hot query scans ~{int(size)} rows of {table} sequentially: {query}"
+                )
@@ -1,8 +1,5 @@
-from time import time
-from collections import defaultdict, namedtuple
-
-User = namedtuple("User", ["id", "last"])
-Item = namedtuple("Item", ["value", "time"])
+from time import monotonic
+from collections import OrderedDict, deque
 
 
 def minmax(minval: float, maxval: float, val: float) -> float:
@@ -10,48 +7,97 @@ def minmax(minval: float, maxval: float, val: float) -> float:
 
 
 class AgedList:
+    """A sliding window of timestamps, oldest first."""
+
+    __slots__ = ("max_age", "items")
+
     def __init__(self, max_age: int = 5):
         self.max_age = max_age
-        self.items = []
+        self.items = deque()
 
-    def clean(self):
-        t = time()
-        for item in self.items:
-            if item.time + self.max_age < t:
-                self.items.remove(item)
+    def clean(self, now: float = None):
+        now = monotonic() if now is None else now
+        items = self.items
+        while items and items[0] + self.max_age < now:
+            items.popleft()
 
-    def add(self, item=1):
-        self.items.append(Item(item, time()))
+    def add(self, now: float = None):
+        now = monotonic() if now is None else now
+        self.items.append(now)
 
-        self.clean()
+        self.clean(now)
 
-    def len(self):
-        self.clean()
+    def len(self, now: float = None):
+        self.clean(now)
 
         return len(self.items)
 
 
+class Channel:
+    """Ratelimit state for a single global channel.
+
+    `users` maps user IDs to the time of their last accepted message and is
+    kept in that order, so users whose cooldown has lapsed are always at the
+    front and can be evicted in amortised O(1).
+    """
+
+    __slots__ = ("users", "activity", "threshold", "last")
+
+    def __init__(self, max_age: int, threshold: float):
+        self.users = OrderedDict()
+        self.activity = AgedList(max_age)
+        self.threshold = threshold
+        self.last = 0.0
+
+
 class Ratelimiter:
-    def __init__(self):
-        self.channel_users = defaultdict(dict)
-        self.channel_activity = defaultdict(AgedList)
-        self.threshold = 1
+    def __init__(self, max_age: int = 5, idle: float = 300):
+        self.channels = {}
+        self.max_age = max_age
         self.max_slowmode = 15
         self.min_slowmode = 1
 
-    def message(self, user_id: int, channel: str):
-        users = self.channel_users[channel]
+        self.idle = idle
+        self.swept = monotonic()
+
+    def evict(self, channel: Channel, now: float):
+        users = channel.users
+        while users:
+            user_id, last = next(iter(users.items()))
+            if last + self.max_slowmode >= now:
+                break
+            del users[user_id]
+
+    def sweep(self, now: float):
+        """Drop channels that haven't seen a message in a while."""
+        self.swept = now
+
+        for name, channel in list(self.channels.items()):
+            if channel.last + self.idle < now:
+                del self.channels[name]
+
+    def message(self, user_id: int, channel: str, now: float = None):
+        now = monotonic() if now is None else now
+
+        if self.swept + self.idle < now:
+            self.sweep(now)
 
-        user = User(**users.get(user_id, {"id": user_id, "last": 0}))
+        state = self.channels.get(channel)
+        if state is None:
+            state = self.channels[channel] = Channel(self.max_age, self.min_slowmode)
 
-        if user.last + self.threshold > time():
-            return round((user.last + self.threshold) - time(), 2)
+        last = state.users.get(user_id)
+        if last is not None and last + state.threshold > now:
+            return round((last + state.threshold) - now, 2)
 
-        self.channel_users[channel][user_id] = {"id": user_id, "last": time()}
-        self.channel_activity[channel].add()
+        state.last = now
+        state.users[user_id] = now
+        state.users.move_to_end(user_id)
+        self.evict(state, now)
 
-        length = self.channel_activity[channel].len()
+        state.activity.add(now)
+        length = len(state.activity.items)
 
-        self.threshold = minmax(self.min_slowmode, self.max_slowmode, length // 4)
+        state.threshold = minmax(self.min_slowmode, self.max_slowmode, length // 4)
 
         return 0
@@ -0,0 +1,119 @@
+from array import array
+from collections import OrderedDict
+from typing import Iterable, Iterator, Optional, Tuple
+
+from src.utils.database import Message
+
+
+class Broadcast:
+    """A relayed message and the copies sent for it.
+
+    Copies are kept as parallel arrays of message and channel IDs instead of a
+    row object per copy, which keeps large broadcasts cheap to hold on to.
+    `deleted` is set once any copy has been deleted, after which the rest
+    only say so and must not be edited back.
+    """
+
+    __slots__ = (
+        "bcid",
+        "guild_id",
+        "channel_id",
+        "author_id",
+        "ids",
+        "channels",
+        "deleted",
+    )
+
+    def __init__(
+        self,
+        bcid: int,
+        guild_id: Optional[int] = None,
+        channel_id: Optional[int] = None,
+        author_id: Optional[int] = None,
+    ):
+        self.bcid = bcid
+        self.guild_id = guild_id
+        self.channel_id = channel_id
+        self.author_id = author_id
+
+        self.ids = array("Q")
+        self.channels = array("Q")
+        self.deleted = False
+
+    def add(self, id: int, channel_id: int):
+        self.ids.append(id)
+        self.channels.append(channel_id)
+
+    def siblings(self) -> Iterator[Tuple[int, int]]:
+        """Yield (message ID, channel ID) for every copy of the original."""
+        return zip(self.ids, self.channels)
+
+
+class Relations:
+    """A bounded LRU mapping any relayed message ID to its broadcast."""
+
+    def __init__(self, maxsize: int = 10_000):
+        self.maxsize = maxsize
+
+        self.groups = OrderedDict()
+        self.index = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def _store(self, group: Broadcast) -> Broadcast:
+        self.groups[group.bcid] = group
+        self.index[group.bcid] = group.bcid
+
+        while len(self.groups) > self.maxsize:
+            _, old = self.groups.popitem(last=False)
+            self.index.pop(old.bcid, None)
+            for id in old.ids:
+                self.index.pop(id, None)
+
+        return group
+
+    def original(
+        self, bcid: int, guild_id: int, channel_id: int, author_id: int
+    ) -> Broadcast:
+        return self._store(Broadcast(bcid, guild_id, channel_id, author_id))
+
+    def sibling(self, bcid: int, id: int, channel_id: int):
+        group = self.groups.get(bcid)
+        if group is None:
+            group = self._store(Broadcast(bcid))
+
+        if id not in self.index:
+            group.add(id, channel_id)
+            self.index[id] = bcid
+
+    def load(self, bcid: int, messages: Iterable[Message]) -> Broadcast:
+        """Build a broadcast from database rows and cache it."""
+        group = Broadcast(bcid)
+
+        for message in messages:
+            group.deleted = group.deleted or message.deleted
+
+            if message.id == bcid:
+                group.guild_id = message.guild_id
+                group.channel_id = message.channel_id
+                group.author_id = message.author_id
+            else:
+                group.add(message.id, message.channel_id)
+
+        self._store(group)
+        for id in group.ids:
+            self.index[id] = bcid
+
+        return group
+
+    def get(self, id: int) -> Optional[Broadcast]:
+        bcid = self.index.get(id)
+
+        if bcid is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.groups.move_to_end(bcid)
+        return self.groups[bcid]
@@ -0,0 +1,138 @@
+from asyncio import FIRST_COMPLETED, get_event_loop, wait
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from datetime import datetime
+from discord.utils import time_snowflake
+from json import dumps, loads
+from os import cpu_count, getenv
+from pathlib import Path
+from typing import FrozenSet, List
+
+from src.utils.filter import Automaton, base_automaton, search
+
+REPORTS = Path(getenv("REPORT_DIR", "./reports"))
+
+Hit = namedtuple(
+    "Hit", ["id", "channel_id", "author_id", "tokens", "censored", "attachments"]
+)
+
+QUERY = """SELECT id, channel_id, author_id, content, attachments FROM Messages
+    WHERE id >= $1 AND id < $2 AND id = bcid AND content IS NOT NULL
+    AND channel_id = ANY($3)
+    ORDER BY id;"""
+
+# Built once in each worker process by _init
+_automata = ()
+_extra = frozenset()
+
+
+def _init(extra: FrozenSet[str]):
+    global _automata, _extra
+    _automata = (base_automaton, Automaton(extra))
+    _extra = extra
+
+
+def _scan(rows: List[tuple]) -> List[Hit]:
+    hits = []
+
+    for id, channel_id, author_id, content, attachments in rows:
+        result = search(_automata, content)
+
+        # Base words were already censored when the message was relayed
+        if result.changed and _extra.intersection(result.tokens):
+            files = loads(attachments) if attachments else []
+            hits.append(
+                Hit(id, channel_id, author_id, result.tokens, result.message, files)
+            )
+
+    return hits
+
+
+class Rescan:
+    """Runs a filter over the originals stored for a time range.
+
+    Rows are streamed from the database in batches and scanned in a process
+    pool, with a bounded number of batches in flight at once. Only matches on
+    the filter's extra words are reported.
+    """
+
+    def __init__(
+        self,
+        db,
+        extra: FrozenSet[str],
+        channels: List[int],
+        start: datetime,
+        stop: datetime,
+        workers: int = None,
+        size: int = 1000,
+    ):
+        self.db = db
+        self.extra = extra
+        self.channels = channels
+        self.lower = time_snowflake(start)
+        self.upper = time_snowflake(stop)
+        self.workers = workers or int(getenv("RESCAN_WORKERS", cpu_count() or 1))
+        self.size = size
+
+        self.position = self.lower
+        self.scanned = 0
+        self.hits: List[Hit] = []
+
+    @property
+    def progress(self) -> float:
+        return (self.position - self.lower) / max(self.upper - self.lower, 1)
+
+    def _collect(self, done: set):
+        for future in done:
+            self.hits += future.result()
+
+    async def run(self) -> List[Hit]:
+        loop = get_event_loop()
+        pending = set()
+
+        # Spawned rather than forked, the bot has threads of its own running
+        pool = ProcessPoolExecutor(
+            self.workers,
+            mp_context=get_context("spawn"),
+            initializer=_init,
+            initargs=(self.extra,),
+        )
+
+        try:
+            rows = self.db.stream(
+                QUERY, self.lower, self.upper, self.channels, size=self.size
+            )
+
+            async for batch in rows:
+                while len(pending) >= self.workers * 2:
+                    done, pending = await wait(pending, return_when=FIRST_COMPLETED)
+                    self._collect(done)
+
+                batch = [tuple(row) for row in batch]
+                pending.add(loop.run_in_executor(pool, _scan, batch))
+
+                self.scanned += len(batch)
+                self.position = batch[-1][0]
+
+            if pending:
+                done, pending = await wait(pending)
+                self._collect(done)
+        finally:
+            # Waiting for the workers here would block the event loop, and after a
+            # failure there's no use finishing the queued batches
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+        self.position = self.upper
+        self.hits.sort()
+        return self.hits
+
+    def report(self, path: Path):
+        """Write the hits as JSON lines."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+
+        with open(path, "w") as f:
+            for hit in self.hits:
+                f.write(dumps(hit._asdict()) + "\n")
@@ -0,0 +1,183 @@
+from asyncio import get_event_loop, sleep
+from datetime import datetime, timedelta
+from discord.utils import time_snowflake
+from gzip import open as gzopen
+from json import dumps, loads
+from loguru import logger
+from os import getenv
+from pathlib import Path
+from re import compile
+from typing import Callable, List, Optional, Tuple
+
+BOUND = compile(r"FROM \((.+?)\) TO \((.+?)\)")
+ARCHIVE = compile(r"messages_(\d+)_(\d+)\.jsonl\.gz")
+COLUMNS = [
+    "id",
+    "bcid",
+    "guild_id",
+    "channel_id",
+    "author_id",
+    "content",
+    "deleted",
+    "attachments",
+]
+
+Partition = Tuple[str, int, int]
+
+
+def _bound(value: str) -> int:
+    value = value.strip("'")
+    return 0 if value == "MINVALUE" else int(value)
+
+
+def _search(path: Path, match: Callable[[list], bool], stop: int) -> List[list]:
+    """Scan an archive file for matching rows, stopping once IDs pass `stop`."""
+    rows = []
+    with gzopen(path, "rt") as f:
+        for line in f:
+            row = loads(line)
+            if row[0] > stop:
+                break
+            if match(row):
+                rows.append(row)
+    return rows
+
+
+class Retention:
+    """Keeps the partitioned Messages table to a fixed number of days.
+
+    Daily partitions are created ahead of time. Partitions that are entirely
+    older than the retention period are streamed to gzipped JSON lines files
+    in the archive directory and then dropped.
+    """
+
+    def __init__(self, db, days: int = None, ahead: int = 7, directory: Path = None):
+        self.db = db
+        self.days = days or int(getenv("RETENTION_DAYS", 30))
+        self.ahead = ahead
+        self.directory = directory or Path(getenv("ARCHIVE_DIR", "./archive"))
+
+    async def partitions(self) -> List[Partition]:
+        """Return (name, lower, upper) for each partition of Messages."""
+        rows = await self.db.fetch(
+            """SELECT c.relname AS name, pg_get_expr(c.relpartbound, c.oid) AS bound
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_class p ON p.oid = i.inhparent
+            WHERE p.relname = 'messages';"""
+        )
+
+        partitions = []
+        for row in rows:
+            lower, upper = BOUND.search(row["bound"]).groups()
+            partitions.append((row["name"], _bound(lower), _bound(upper)))
+
+        return sorted(partitions, key=lambda p: p[2])
+
+    async def create_partitions(self, partitions: List[Partition]):
+        highest = max((p[2] for p in partitions), default=0)
+        today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+
+        for offset in range(self.ahead + 1):
+            day = today + timedelta(days=offset)
+            upper = time_snowflake(day + timedelta(days=1))
+            if upper <= highest:
+                continue
+
+            lower = max(time_snowflake(day), highest)
+            name = f"messages_p{day:%Y%m%d}"
+
+            await self.db.execute(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF Messages "
+                f"FOR VALUES FROM ({lower}) TO ({upper});"
+            )
+            logger.info(f"Created partition {name}")
+            highest = upper
+
+    async def archive(self, name: str, lower: int, upper: int):
+        """Stream a partition to a compressed file, then drop it."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        path = self.directory / f"messages_{lower}_{upper}.jsonl.gz"
+        partial = path.with_suffix(".partial")
+        loop = get_event_loop()
+
+        f = gzopen(partial, "wt")
+        try:
+            async with self.db.pool.acquire() as conn:
+                async with conn.transaction():
+                    batch = []
+                    query = f"SELECT {', '.join(COLUMNS)} FROM {name} ORDER BY id;"
+
+                    async for row in conn.cursor(query, prefetch=1000):
+                        batch.append(dumps(list(row)) + "\n")
+                        if len(batch) >= 1000:
+                            await loop.run_in_executor(None, f.writelines, batch)
+                            batch = []
+
+                    await loop.run_in_executor(None, f.writelines, batch)
+        finally:
+            f.close()
+
+        partial.rename(path)
+
+        await self.db.execute(f"ALTER TABLE Messages DETACH PARTITION {name};")
+        await self.db.execute(f"DROP TABLE {name};")
+
+        logger.info(f"Archived partition {name} to {path}")
+
+    async def prepare(self):
+        """Create today's and upcoming partitions, so rows always have a home."""
+        await self.create_partitions(await self.partitions())
+
+    async def maintain(self):
+        partitions = await self.partitions()
+        await self.create_partitions(partitions)
+
+        cutoff = time_snowflake(datetime.utcnow() - timedelta(days=self.days))
+        for name, lower, upper in partitions:
+            if upper <= cutoff:
+                await self.archive(name, lower, upper)
+
+    async def run(self, interval: float = 3600):
+        while True:
+            await sleep(interval)
+            try:
+                await self.maintain()
+            except Exception as e:
+                logger.error(f"Message retention failed: {e}")
+
+    async def start(self):
+        """Archive old partitions now, then keep maintaining them in the background.
+
+        The background task is started first, so a failure here is retried.
+        """
+        get_event_loop().create_task(self.run())
+        await self.maintain()
+
+    async def lookup(self, match: Callable[[list], bool], start: int, stop: int):
+        """Find archived rows with IDs in [start, stop] that satisfy `match`."""
+        loop = get_event_loop()
+        rows = []
+
+        for path in sorted(self.directory.glob("messages_*.jsonl.gz")):
+            bounds = ARCHIVE.fullmatch(path.name)
+            if not bounds:
+                continue
+
+            lower, upper = map(int, bounds.groups())
+            if upper <= start or lower > stop:
+                continue
+
+            rows += await loop.run_in_executor(None, _search, path, match, stop)
+
+        return rows
+
+    async def find(self, id: int) -> Optional[list]:
+        rows = await self.lookup(lambda row: row[0] == id, id, id)
+        return rows[0] if rows else None
+
+    async def find_broadcast(self, bcid: int, window: int = 3600) -> List[list]:
+        """Find a broadcast's rows, assuming copies were sent within `window` seconds."""
+        stop = bcid + ((window * 1000) << 22)
+        return await self.lookup(lambda row: row[1] == bcid, bcid, stop)
@@ -0,0 +1,72 @@
+from collections import defaultdict
+from discord import TextChannel
+from loguru import logger
+from typing import Dict, List, Optional, Set
+
+from src.internal.bot import Bot
+
+
+class RoutingTable:
+    """Maps linked channels to their global channel and back.
+
+    Guilds are applied one at a time, so linking or unlinking a channel only
+    touches that guild's routes. Channel objects are resolved on first use and
+    channels the bot can no longer see are dropped from the table.
+    """
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+
+        self.mapping: Dict[int, str] = {}
+        self.guilds: Dict[int, Set[int]] = defaultdict(set)
+        self.channels: Dict[str, Dict[int, Optional[TextChannel]]] = defaultdict(dict)
+
+    def __contains__(self, channel_id: int) -> bool:
+        return channel_id in self.mapping
+
+    def get(self, channel_id: int) -> Optional[str]:
+        return self.mapping.get(channel_id)
+
+    def remove(self, guild_id: int):
+        for local in self.guilds.pop(guild_id, ()):
+            self.discard(local)
+
+    def apply(self, guild_id: int, config: dict):
+        """Replace a guild's routes with those in its config."""
+        self.remove(guild_id)
+
+        for local, glob in config.get("channels", {}).items():
+            local = int(local)
+
+            self.mapping[local] = glob
+            self.guilds[guild_id].add(local)
+            self.channels[glob][local] = None
+
+    def discard(self, local: int):
+        """Remove a single channel from the table."""
+        glob = self.mapping.pop(local, None)
+        if glob is None:
+            return
+
+        self.channels[glob].pop(local, None)
+        if not self.channels[glob]:
+            del self.channels[glob]
+
+    def destinations(self, glob: str) -> List[TextChannel]:
+        """Resolve every channel linked to a global channel."""
+        resolved = []
+
+        for local, channel in list(self.channels.get(glob, {}).items()):
+            if channel is None:
+                channel = self.bot.get_channel(local)
+
+                if channel is None:
+                    logger.warning(f"Dropping unresolvable channel {local} from {glob}")
+                    self.discard(local)
+                    continue
+
+                self.channels[glob][local] = channel
+
+            resolved.append(channel)
+
+        return resolved
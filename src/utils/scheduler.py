@@ -0,0 +1,182 @@
+from asyncio import CancelledError, Event, Future, sleep, get_event_loop
+from collections import OrderedDict, deque
+from enum import IntEnum
+from itertools import count
+from loguru import logger
+from time import monotonic
+from typing import Coroutine, Dict, Hashable, Optional, Tuple
+
+
+class Priority(IntEnum):
+    """Outbound work classes, lower values are served first."""
+
+    RELAY = 0
+    EDIT = 1
+    ANNOUNCE = 2
+    LOG = 3
+
+
+class Dropped(Exception):
+    """The job was dropped because its queue was full."""
+
+
+class Job:
+    __slots__ = ("coro", "futures", "queued", "cost")
+
+    def __init__(self, coro: Coroutine, future: Future, cost: int):
+        self.coro = coro
+        self.futures = [future]
+        self.queued = monotonic()
+        self.cost = cost
+
+
+def _consume(future: Future):
+    # Errors are logged by the worker, don't warn about unretrieved exceptions
+    if not future.cancelled():
+        future.exception()
+
+
+class Scheduler:
+    """A priority queue for outbound Discord requests.
+
+    Jobs are served strictly by priority and paced to a global request budget.
+    Each queue has a maximum depth: when it is full the oldest job is dropped.
+    Jobs submitted with a key replace a queued job with the same key, so only
+    the latest version of, say, an edit to one message is sent.
+    """
+
+    DEPTH = {
+        Priority.RELAY: 5_000,
+        Priority.EDIT: 5_000,
+        Priority.ANNOUNCE: 20_000,
+        Priority.LOG: 1_000,
+    }
+
+    def __init__(self, rate: float = 40.0, burst: float = 10.0, workers: int = 16):
+        self.rate = rate
+        self.burst = burst
+        self.workers = workers
+
+        self.queues: Dict[Priority, OrderedDict] = {p: OrderedDict() for p in Priority}
+        self.latency = {p: deque(maxlen=1_000) for p in Priority}
+        self.dropped = {p: 0 for p in Priority}
+        self.merged = {p: 0 for p in Priority}
+
+        self.tokens = burst
+        self.refilled = monotonic()
+        self.keys = count()
+        self.wakeup = Event()
+        self.tasks = []
+
+    def start(self):
+        loop = get_event_loop()
+        self.tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+
+    def submit(
+        self,
+        priority: Priority,
+        coro: Coroutine,
+        key: Optional[Hashable] = None,
+        cost: int = 1,
+    ) -> Future:
+        """Queue a coroutine, returning a future for its result.
+
+        `cost` is the number of requests the coroutine makes against the budget,
+        jobs costing 0 are never held back by it.
+        """
+        if not self.tasks:
+            self.start()
+
+        future = get_event_loop().create_future()
+        future.add_done_callback(_consume)
+
+        queue = self.queues[priority]
+        key = next(self.keys) if key is None else key
+
+        if key in queue:
+            old = queue[key]
+            old.coro.close()
+            old.coro = coro
+            old.cost = cost
+            old.futures.append(future)
+            self.merged[priority] += 1
+            return future
+
+        queue[key] = Job(coro, future, cost)
+
+        if len(queue) > self.DEPTH[priority]:
+            _, job = queue.popitem(last=False)
+            job.coro.close()
+            for f in job.futures:
+                if not f.done():
+                    f.set_exception(Dropped(f"{priority.name} queue is full"))
+            self.dropped[priority] += 1
+
+        self.wakeup.set()
+        return future
+
+    def _next(self) -> Tuple[Optional[Priority], Optional[Job]]:
+        for priority, queue in self.queues.items():
+            if queue:
+                return priority, queue.popitem(last=False)[1]
+        return None, None
+
+    async def _take(self, cost: int):
+        if not cost:
+            return  # Not paced by the budget, like webhook sends
+
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+        # Go into debt and wait it off, so concurrent workers pace correctly
+        self.tokens -= cost
+        if self.tokens < 0:
+            await sleep(-self.tokens / self.rate)
+
+    async def _worker(self):
+        while True:
+            priority, job = self._next()
+
+            if job is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+
+            await self._take(job.cost)
+            self.latency[priority].append(monotonic() - job.queued)
+
+            try:
+                result = await job.coro
+            except CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Scheduled job failed: {e.__class__.__name__}: {e}")
+                for f in job.futures:
+                    if not f.done():
+                        f.set_exception(e)
+            else:
+                for f in job.futures:
+                    if not f.done():
+                        f.set_result(result)
+
+    def stats(self) -> dict:
+        """Queue depth, recent queue latency and drop/merge counts per priority."""
+        stats = {}
+
+        for priority in Priority:
+            latency = self.latency[priority]
+            stats[priority.name.lower()] = {
+                "depth": len(self.queues[priority]),
+                "latency_avg": sum(latency) / len(latency) if latency else 0.0,
+                "latency_max": max(latency, default=0.0),
+                "dropped": self.dropped[priority],
+                "merged": self.merged[priority],
+            }
+
+        return stats
@@ -0,0 +1,155 @@
+from collections import deque
+from os import getenv
+from sys import byteorder
+from time import monotonic
+from typing import Dict, Optional
+
+from src.utils.filter import BOUNDARY, fold
+
+MASK = (1 << 64) - 1
+BANDS = 4
+BAND_BITS = 16
+
+# Spreads each bit of a byte into its own 16 bit lane, so the per-bit counts
+# for simhash can be summed with one big integer addition per feature
+SPREAD = [
+    sum(((byte >> bit) & 1) << (bit * 16) for bit in range(8)) for byte in range(256)
+]
+
+
+def canonical(content: str, limit: int = 512) -> str:
+    """Fold content into the filter alphabet, collapsing whitespace."""
+    chars = []
+    for char in content[:limit]:
+        folded = fold(char)
+        if folded == BOUNDARY and (not chars or chars[-1] == BOUNDARY):
+            continue
+        chars.append(folded)
+    return "".join(chars).strip()
+
+
+def simhash(text: str) -> int:
+    """A 64 bit simhash of the words and word pairs of some canonical text."""
+    words = text.split(BOUNDARY)
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    counts = 0
+    for feature in features:
+        h = hash(feature) & MASK
+        counts += (
+            SPREAD[h & 0xFF]
+            | SPREAD[(h >> 8) & 0xFF] << 128
+            | SPREAD[(h >> 16) & 0xFF] << 256
+            | SPREAD[(h >> 24) & 0xFF] << 384
+            | SPREAD[(h >> 32) & 0xFF] << 512
+            | SPREAD[(h >> 40) & 0xFF] << 640
+            | SPREAD[(h >> 48) & 0xFF] << 768
+            | SPREAD[h >> 56] << 896
+        )
+
+    # Each bit is set if it was set in more than half of the features
+    lanes = memoryview(counts.to_bytes(128, byteorder)).cast("H")
+    half = len(features) / 2
+
+    fingerprint = 0
+    for bit, count in enumerate(lanes):
+        if count > half:
+            fingerprint |= 1 << bit
+
+    return fingerprint
+
+
+def distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class SpamDetector:
+    """Spots the same text being posted by many authors or in many guilds.
+
+    Fingerprints from the last `window` seconds are indexed by each of their
+    four 16 bit bands. Any two fingerprints within `max_distance` bits share
+    at least one band, so only those buckets are compared. Buckets are capped
+    at `bucket_size`, keeping the work per message constant.
+
+    Short greetings are often repeated by many people at once, so only text
+    of at least `min_length` folded characters is checked, and the thresholds
+    are set well above what a busy channel produces by chance.
+    """
+
+    def __init__(
+        self,
+        window: float = None,
+        max_distance: int = 3,
+        authors: int = None,
+        guilds: int = None,
+        min_length: int = None,
+        bucket_size: int = 32,
+    ):
+        self.window = window or float(getenv("SPAM_WINDOW", 30))
+        self.max_distance = max_distance
+        self.authors = authors or int(getenv("SPAM_AUTHORS", 8))
+        self.guilds = guilds or int(getenv("SPAM_GUILDS", 6))
+        self.min_length = min_length or int(getenv("SPAM_MIN_LENGTH", 48))
+        self.bucket_size = bucket_size
+
+        self.buckets: Dict[int, deque] = {}
+        self.recent = deque()
+
+    def _expire(self, now: float):
+        cutoff = now - self.window
+        recent = self.recent
+
+        while recent and recent[0][0] < cutoff:
+            _, fingerprint, _, _ = recent.popleft()
+
+            for key in self._keys(fingerprint):
+                bucket = self.buckets.get(key)
+                while bucket and bucket[0][0] < cutoff:
+                    bucket.popleft()
+                if bucket is not None and not bucket:
+                    del self.buckets[key]
+
+    @staticmethod
+    def _keys(fingerprint: int):
+        # The band number is kept in the key so bands don't collide
+        for band in range(BANDS):
+            value = (fingerprint >> (band * BAND_BITS)) & ((1 << BAND_BITS) - 1)
+            yield (band << BAND_BITS) | value
+
+    def message(
+        self, content: str, author_id: int, guild_id: int, now: Optional[float] = None
+    ) -> bool:
+        """Record a message, returning whether it is part of a flood of copies."""
+        now = monotonic() if now is None else now
+        self._expire(now)
+
+        text = canonical(content)
+        if len(text) < self.min_length:
+            return False
+
+        fingerprint = simhash(text)
+        entry = (now, fingerprint, author_id, guild_id)
+
+        authors = {author_id}
+        guilds = {guild_id}
+        seen = set()
+
+        for key in self._keys(fingerprint):
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = deque(maxlen=self.bucket_size)
+
+            for other in bucket:
+                if other in seen:
+                    continue
+                seen.add(other)
+
+                if distance(fingerprint, other[1]) <= self.max_distance:
+                    authors.add(other[2])
+                    guilds.add(other[3])
+
+            bucket.append(entry)
+
+        self.recent.append(entry)
+
+        return len(authors) >= self.authors or len(guilds) >= self.guilds
@@ -0,0 +1,127 @@
+import sqlite3
+
+from asyncio import get_event_loop
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from json import dumps, loads
+from loguru import logger
+from os import getenv
+from pathlib import Path
+from re import compile
+from typing import Callable, List
+
+from src.utils.database import Database, MessageBuffer
+
+SCHEMA = Path("./static/sqlite.sql")
+PLACEHOLDER = compile(r"\$(\d+)")
+ANY = compile(r"= ANY\(\$(\d+)\)")
+
+sqlite3.register_adapter(dict, dumps)
+sqlite3.register_adapter(list, dumps)
+sqlite3.register_converter("JSON", loads)
+sqlite3.register_converter("BOOLEAN", lambda value: value != b"0")
+sqlite3.register_converter(
+    "TIMESTAMP", lambda value: datetime.fromisoformat(value.decode())
+)
+
+
+class SQLiteDatabase(Database):
+    """An embedded database for small, single process installs.
+
+    One connection in WAL mode is owned by a single executor thread, so
+    statements run in order without blocking the event loop. Triggers call
+    back into Python to invalidate caches, in place of LISTEN/NOTIFY.
+    """
+
+    def __init__(self, path: str = None):
+        super().__init__()
+        self.path = path or getenv("DB_PATH", "./crosschat.db")
+
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.conn = None
+        self.loop = None
+
+    def _run(self, fn: Callable, *args):
+        return self.loop.run_in_executor(self.executor, fn, *args)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        conn.row_factory = sqlite3.Row
+
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        conn.create_function("crosschat_notify", 2, self._on_notify)
+        conn.executescript(SCHEMA.read_text())
+
+        # Added after the first release, CREATE TABLE IF NOT EXISTS won't add it
+        columns = [row["name"] for row in conn.execute("PRAGMA table_info(Messages);")]
+        if "attachments" not in columns:
+            conn.execute("ALTER TABLE Messages ADD COLUMN attachments TEXT;")
+
+        return conn
+
+    def _on_notify(self, table: str, id: int):
+        # Runs on the executor thread from inside the statement that changed the row
+        self.loop.call_soon_threadsafe(self.invalidate, table, id)
+
+    async def setup(self):
+        logger.info(f"Opening SQLite database {self.path}...")
+        self.loop = get_event_loop()
+        self.conn = await self._run(self._connect)
+
+        logger.info("Database setup complete.")
+
+    async def close(self):
+        """Write any buffered messages and close the connection."""
+        # Setup may have failed before the connection was opened
+        if self.conn is not None:
+            await super().close()
+            conn, self.conn = self.conn, None
+            await self._run(conn.close)
+
+        self.executor.shutdown()
+
+    @staticmethod
+    def _query(query: str) -> str:
+        # Lists are bound as JSON arrays, so `= ANY($n)` can be unpacked
+        query = ANY.sub(r"IN (SELECT value FROM json_each($\1))", query)
+        return PLACEHOLDER.sub(r"?\1", query)
+
+    async def execute(self, query: str, *args):
+        await self._run(self.conn.execute, self._query(query), args)
+
+    async def fetchrow(self, query: str, *args):
+        query = self._query(query)
+        return await self._run(lambda: self.conn.execute(query, args).fetchone())
+
+    async def fetch(self, query: str, *args):
+        query = self._query(query)
+        return await self._run(lambda: self.conn.execute(query, args).fetchall())
+
+    async def stream(self, query: str, *args, size: int = 1000):
+        cursor = await self._run(self.conn.execute, self._query(query), args)
+
+        while batch := await self._run(cursor.fetchmany, size):
+            yield batch
+
+    async def write_messages(self, rows: List[tuple]):
+        columns = ", ".join(MessageBuffer.COLUMNS)
+        values = ", ".join("?" * len(MessageBuffer.COLUMNS))
+        query = f"INSERT OR IGNORE INTO Messages ({columns}) VALUES ({values});"
+
+        def write():
+            # One transaction per batch instead of one per row
+            self.conn.execute("BEGIN;")
+            try:
+                self.conn.executemany(query, rows)
+            except Exception:
+                self.conn.execute("ROLLBACK;")
+                raise
+            self.conn.execute("COMMIT;")
+
+        await self._run(write)
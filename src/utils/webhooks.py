@@ -0,0 +1,132 @@
+from asyncio import Lock, sleep
+from collections import defaultdict
+from discord import Embed, TextChannel
+from loguru import logger
+from time import monotonic
+
+from src.internal.bot import Bot
+
+UNKNOWN_WEBHOOK = 10015
+
+
+class WebhookGone(Exception):
+    """The webhook was deleted or its token is no longer valid."""
+
+
+class Bucket:
+    """Rate limit state for a single webhook."""
+
+    __slots__ = ("lock", "remaining", "reset")
+
+    def __init__(self):
+        self.lock = Lock()
+        self.remaining = 1
+        self.reset = 0.0
+
+    async def wait(self):
+        if self.remaining <= 0 and (delay := self.reset - monotonic()) > 0:
+            await sleep(delay)
+
+    def update(self, headers):
+        if "X-RateLimit-Remaining" in headers:
+            self.remaining = int(headers["X-RateLimit-Remaining"])
+        if "X-RateLimit-Reset-After" in headers:
+            self.reset = monotonic() + float(headers["X-RateLimit-Reset-After"])
+
+
+class WebhookTransport:
+    """Delivers messages through per-channel webhooks on the bot's HTTP session.
+
+    Webhook URLs are stored in the guild config under `webhooks` and created
+    the first time a channel needs one. Each webhook has its own rate limit
+    bucket, separate from the bot's global limit.
+    """
+
+    def __init__(self, bot: Bot, retries: int = 3):
+        self.bot = bot
+        self.retries = retries
+
+        self.buckets = defaultdict(Bucket)
+        self.creating = defaultdict(Lock)
+
+    async def url(self, channel: TextChannel) -> str:
+        async with self.creating[channel.id]:
+            guild = await self.bot.db.get_guild(channel.guild.id)
+            webhooks = guild.config.setdefault("webhooks", {})
+
+            if str(channel.id) not in webhooks:
+                webhook = await channel.create_webhook(name="CrossChat")
+                webhooks[str(channel.id)] = webhook.url
+
+                await self.bot.db.update_guild(channel.guild.id, guild.config)
+                logger.info(f"Created webhook for {channel.id}")
+
+            return webhooks[str(channel.id)]
+
+    async def forget(self, channel: TextChannel):
+        """Remove a dead webhook so it is recreated on the next send."""
+        guild = await self.bot.db.get_guild(channel.guild.id)
+        url = guild.config.get("webhooks", {}).pop(str(channel.id), None)
+
+        if url:
+            self.buckets.pop(url, None)
+            await self.bot.db.update_guild(channel.guild.id, guild.config)
+
+    async def request(
+        self,
+        channel: TextChannel,
+        method: str,
+        path: str = "",
+        params: dict = None,
+        **payload,
+    ) -> dict:
+        url = await self.url(channel)
+
+        bucket = self.buckets[url]
+        async with bucket.lock:
+            for _ in range(self.retries):
+                await bucket.wait()
+
+                async with self.bot.http_session.request(
+                    method, url + path, params=params, json=payload
+                ) as resp:
+                    bucket.update(resp.headers)
+
+                    if resp.status == 429:
+                        await sleep(float(resp.headers.get("Retry-After", 1)))
+                        continue
+
+                    if resp.status in (401, 404):
+                        error = await resp.json()
+                        if resp.status == 401 or error.get("code") == UNKNOWN_WEBHOOK:
+                            await self.forget(channel)
+                            raise WebhookGone(f"Webhook for {channel.id} is gone")
+
+                    resp.raise_for_status()
+                    return await resp.json()
+
+        raise RuntimeError(f"Webhook for {channel.id} is still rate limited")
+
+    async def send(
+        self, channel: TextChannel, content: str = None, embed: Embed = None
+    ) -> dict:
+        """Send a message through the channel's webhook, returning the message data."""
+        payload = {"allowed_mentions": {"parse": []}}
+        if content:
+            payload["content"] = content
+        if embed:
+            payload["embeds"] = [embed.to_dict()]
+
+        return await self.request(channel, "POST", params={"wait": "true"}, **payload)
+
+    async def edit(
+        self, channel: TextChannel, message: int, content: str = None, embed=...
+    ) -> dict:
+        """Edit a message previously sent through the channel's webhook."""
+        payload = {}
+        if content is not None:
+            payload["content"] = content
+        if embed is not ...:
+            payload["embeds"] = [embed] if embed else []
+
+        return await self.request(channel, "PATCH", f"/messages/{message}", **payload)
@@ -0,0 +1,2 @@
+CREATE INDEX IF NOT EXISTS messages_bcid_idx ON Messages (bcid);
+CREATE INDEX IF NOT EXISTS messages_author_id_idx ON Messages (author_id);
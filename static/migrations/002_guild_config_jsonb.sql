@@ -0,0 +1,3 @@
+ALTER TABLE Guilds ALTER COLUMN config DROP DEFAULT;
+ALTER TABLE Guilds ALTER COLUMN config TYPE JSONB USING config::jsonb;
+ALTER TABLE Guilds ALTER COLUMN config SET DEFAULT '{}'::jsonb;
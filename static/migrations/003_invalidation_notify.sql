@@ -0,0 +1,27 @@
+CREATE OR REPLACE FUNCTION crosschat_notify_invalidate() RETURNS TRIGGER AS $$
+DECLARE
+    row_id BIGINT;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_id := OLD.id;
+    ELSE
+        row_id := NEW.id;
+    END IF;
+
+    PERFORM pg_notify(
+        'crosschat_invalidate',
+        json_build_object('table', lower(TG_TABLE_NAME), 'id', row_id)::text
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS users_invalidate ON Users;
+CREATE TRIGGER users_invalidate
+    AFTER INSERT OR UPDATE OR DELETE ON Users
+    FOR EACH ROW EXECUTE PROCEDURE crosschat_notify_invalidate();
+
+DROP TRIGGER IF EXISTS guilds_invalidate ON Guilds;
+CREATE TRIGGER guilds_invalidate
+    AFTER INSERT OR UPDATE OR DELETE ON Guilds
+    FOR EACH ROW EXECUTE PROCEDURE crosschat_notify_invalidate();
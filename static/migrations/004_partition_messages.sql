@@ -0,0 +1,47 @@
+-- Partition Messages by snowflake ID (and so by time), keeping the existing
+-- table as the first partition. Content is only kept on the original row.
+ALTER TABLE Messages RENAME TO Messages_legacy;
+ALTER INDEX messages_pkey RENAME TO messages_legacy_pkey;
+ALTER INDEX IF EXISTS messages_bcid_idx RENAME TO messages_legacy_bcid_idx;
+ALTER INDEX IF EXISTS messages_author_id_idx RENAME TO messages_legacy_author_id_idx;
+
+ALTER TABLE Messages_legacy ALTER COLUMN content DROP NOT NULL;
+UPDATE Messages_legacy SET content = NULL WHERE id <> bcid;
+
+CREATE TABLE Messages (
+    id              BIGINT NOT NULL,
+    bcid            BIGINT NOT NULL,
+    guild_id        BIGINT NOT NULL,
+    channel_id      BIGINT NOT NULL,
+    author_id       BIGINT NOT NULL,
+    content         TEXT,
+    deleted         BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (id)
+) PARTITION BY RANGE (id);
+
+CREATE INDEX messages_bcid_idx ON Messages (bcid);
+CREATE INDEX messages_author_id_idx ON Messages (author_id);
+
+CREATE OR REPLACE FUNCTION crosschat_snowflake(ts TIMESTAMP) RETURNS BIGINT AS $$
+    SELECT ((extract(epoch FROM ts) * 1000)::BIGINT - 1420070400000) << 22;
+$$ LANGUAGE SQL IMMUTABLE;
+
+DO $$
+DECLARE
+    bound BIGINT;
+BEGIN
+    SELECT GREATEST(
+        crosschat_snowflake(date_trunc('day', now() AT TIME ZONE 'utc')),
+        COALESCE(MAX(id) + 1, 0)
+    ) INTO bound FROM Messages_legacy;
+
+    -- The check lets the attach skip validating every row a second time
+    EXECUTE format(
+        'ALTER TABLE Messages_legacy ADD CONSTRAINT messages_legacy_range CHECK (id < %s)',
+        bound
+    );
+    EXECUTE format(
+        'ALTER TABLE Messages ATTACH PARTITION Messages_legacy FOR VALUES FROM (MINVALUE) TO (%s)',
+        bound
+    );
+END $$;
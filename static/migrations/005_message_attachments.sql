@@ -0,0 +1,3 @@
+-- Relayed attachments of an original as a JSON list of [filename, url] pairs,
+-- so edits and rescans can rebuild its embed. Copies leave this NULL.
+ALTER TABLE Messages ADD COLUMN IF NOT EXISTS attachments TEXT;
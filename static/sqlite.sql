@@ -0,0 +1,59 @@
+-- The schema for the embedded SQLite backend, kept in step with init.sql and
+-- the Postgres migrations. Content is only kept on the original row.
+CREATE TABLE IF NOT EXISTS Users (
+    id              INTEGER NOT NULL PRIMARY KEY,
+    permissions     INT NOT NULL DEFAULT 0,
+    banned          BOOLEAN NOT NULL DEFAULT FALSE,
+    created_at      TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS Guilds (
+    id              INTEGER NOT NULL PRIMARY KEY,
+    config          JSON NOT NULL DEFAULT '{}',
+    created_at      TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS Messages (
+    id              INTEGER NOT NULL PRIMARY KEY,
+    bcid            INTEGER NOT NULL,
+    guild_id        INTEGER NOT NULL,
+    channel_id      INTEGER NOT NULL,
+    author_id       INTEGER NOT NULL,
+    content         TEXT,
+    deleted         BOOLEAN NOT NULL DEFAULT FALSE,
+    attachments     TEXT
+);
+
+CREATE INDEX IF NOT EXISTS messages_bcid_idx ON Messages (bcid);
+CREATE INDEX IF NOT EXISTS messages_author_id_idx ON Messages (author_id);
+
+-- crosschat_notify is registered on the connection by SQLiteDatabase
+CREATE TRIGGER IF NOT EXISTS users_insert_invalidate AFTER INSERT ON Users
+BEGIN
+    SELECT crosschat_notify('users', NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_update_invalidate AFTER UPDATE ON Users
+BEGIN
+    SELECT crosschat_notify('users', NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS users_delete_invalidate AFTER DELETE ON Users
+BEGIN
+    SELECT crosschat_notify('users', OLD.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS guilds_insert_invalidate AFTER INSERT ON Guilds
+BEGIN
+    SELECT crosschat_notify('guilds', NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS guilds_update_invalidate AFTER UPDATE ON Guilds
+BEGIN
+    SELECT crosschat_notify('guilds', NEW.id);
+END;
+
+CREATE TRIGGER IF NOT EXISTS guilds_delete_invalidate AFTER DELETE ON Guilds
+BEGIN
+    SELECT crosschat_notify('guilds', OLD.id);
+END;
@@ -0,0 +1,128 @@
+from asyncio import Event, ensure_future, gather, sleep
+from unittest import IsolatedAsyncioTestCase, main
+
+from src.utils.cache import LRU, AsyncCache
+
+
+class TestLRU(IsolatedAsyncioTestCase):
+    async def test_evicts_least_recently_used(self):
+        cache = LRU(2)
+        cache.set(1, "a")
+        cache.set(2, "b")
+        cache.get(1)
+        cache.set(3, "c")
+
+        self.assertIn(1, cache)
+        self.assertNotIn(2, cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+
+
+class TestAsyncCache(IsolatedAsyncioTestCase):
+    def loader(self, value=lambda key: key * 2):
+        self.calls = 0
+        self.release = Event()
+        self.release.set()
+
+        async def load(key):
+            self.calls += 1
+            await self.release.wait()
+            return value(key)
+
+        return load
+
+    async def test_concurrent_misses_share_one_load(self):
+        cache = AsyncCache(self.loader())
+        self.release.clear()
+
+        pending = gather(*[cache.get(1) for _ in range(5)])
+        await sleep(0)
+        self.release.set()
+
+        self.assertEqual(await pending, [2] * 5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(await cache.get(1), 2)
+        self.assertEqual(cache.stats()["hits"], 1)
+
+    async def test_none_expires_after_negative_ttl(self):
+        cache = AsyncCache(self.loader(lambda key: None), negative_ttl=0)
+
+        self.assertIsNone(await cache.get(1))
+        self.assertIsNone(await cache.get(1))
+        self.assertEqual(self.calls, 2)
+
+    async def test_expired_values_are_reloaded(self):
+        cache = AsyncCache(self.loader(), ttl=0)
+
+        await cache.get(1)
+        await cache.get(1)
+        self.assertEqual(self.calls, 2)
+
+    async def test_value_invalidated_while_loading_is_not_cached(self):
+        cache = AsyncCache(self.loader())
+        self.release.clear()
+
+        task = ensure_future(cache.get(1))
+        await sleep(0)
+        cache.pop(1)
+        self.release.set()
+
+        self.assertEqual(await task, 2)
+        self.assertNotIn(1, cache)
+
+    async def test_errors_reach_every_waiter(self):
+        async def load(key):
+            await sleep(0)
+            raise ValueError(key)
+
+        cache = AsyncCache(load)
+        results = await gather(cache.get(1), cache.get(1), return_exceptions=True)
+
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertFalse(cache.loading)
+
+    async def test_cancelled_load_does_not_strand_waiters(self):
+        cache = AsyncCache(self.loader())
+        self.release.clear()
+
+        first = ensure_future(cache.get(1))
+        await sleep(0)
+        second = ensure_future(cache.get(1))
+        await sleep(0)
+
+        first.cancel()
+        await sleep(0)
+        self.release.set()
+
+        self.assertEqual(await second, 2)
+        self.assertTrue(first.cancelled())
+        self.assertEqual(self.calls, 2)
+        self.assertFalse(cache.loading)
+
+    async def test_cancelled_waiter_leaves_load_running(self):
+        cache = AsyncCache(self.loader())
+        self.release.clear()
+
+        first = ensure_future(cache.get(1))
+        await sleep(0)
+        second = ensure_future(cache.get(1))
+        await sleep(0)
+
+        second.cancel()
+        await sleep(0)
+        self.release.set()
+
+        self.assertEqual(await first, 2)
+        self.assertTrue(second.cancelled())
+        self.assertEqual(self.calls, 1)
+
+    def test_evicts_past_maxsize(self):
+        cache = AsyncCache(self.loader(), maxsize=2)
+        for key in range(3):
+            cache.set(key, key)
+
+        self.assertNotIn(0, cache)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+
+if __name__ == "__main__":
+    main()